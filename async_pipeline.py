@@ -0,0 +1,209 @@
+"""Required functions to run the PAR and score stages as asyncio pipelines, keeping a bounded
+number of queries in flight while the earlier results are written to MySQL in batches"""
+import re
+import time
+import asyncio
+import hashlib
+import asyncpg
+import aiomysql
+
+import calculate_par
+import calculate_scores
+from profiling import profiler
+from connections import get_main_arguments, get_osm_arguments
+
+# The number of finished batches waiting to be written, the queries pause when it is full
+QUEUE_SIZE = 4
+
+# The number of rows written with a single executemany
+WRITE_BATCH_SIZE = 5000
+
+# The statements writing the PAR results and the score checkpoint
+RATIO_UPDATE = (
+    "UPDATE CovidAlerter.Neighbourhoods "
+    "SET Ratio = %s, OutdoorArea = %s, HouseArea = %s, CommercialArea = %s WHERE Id = %s"
+)
+FINGERPRINT_UPSERT = (
+    "INSERT INTO CovidAlerter.ParFingerprints (NeighbourhoodId, Fingerprint) VALUES (%s, %s) "
+    "ON DUPLICATE KEY UPDATE Fingerprint = VALUES(Fingerprint)"
+)
+CHECKPOINT_UPSERT = (
+    "INSERT INTO CovidAlerter.Checkpoints (Name, Value) VALUES (%s, %s) "
+    "ON DUPLICATE KEY UPDATE Value = VALUES(Value)"
+)
+
+
+def run_par_pipeline(neighbourhoods: list, workers: int = 1, full: bool = False) -> None:
+    """Calculate the Person-Area Ratio for the specified Neighbourhoods ([(Id, osm_id)]),
+    skipping the ones whose inputs haven't changed, and store them in a single transaction
+    (the caller stores the checkpoint)"""
+    asyncio.run(run_par(neighbourhoods, workers, full))
+
+
+def run_score_pipeline(mark: int, last_id: int, date) -> None:
+    """Find the stays in the reports after the high-water mark up to last_id with the streaming
+    state machine, add their counts to the date's counts (or replace them if the mark is 0) and
+    calculate the date's scores from them, along with the checkpoint"""
+    asyncio.run(run_scores(mark, last_id, date))
+
+
+async def run_par(neighbourhoods: list, workers: int, full: bool) -> None:
+    """Run the PAR pipeline (see run_par_pipeline)"""
+    # Map each OSM id to the neighbourhoods which are stored with it
+    neighbourhood_ids = {}
+    for neighbourhood_id, osm_id in neighbourhoods:
+        neighbourhood_ids.setdefault(osm_id, []).append(neighbourhood_id)
+    osm_ids = list(neighbourhood_ids)
+    batches = [osm_ids[index:index + calculate_par.BATCH_SIZE]
+               for index in range(0, len(osm_ids), calculate_par.BATCH_SIZE)]
+    settings_hash = calculate_par.get_settings_hash()
+
+    osm_pool = await asyncpg.create_pool(**get_osm_arguments(), min_size=1, max_size=workers)
+    connection = await aiomysql.connect(**get_main_arguments(), autocommit=False)
+    try:
+        stored_fingerprints = {}
+        # The neighbourhoods stored before their areas were added are calculated again too
+        missing_areas = set()
+        if neighbourhoods:
+            chunk_ids = [neighbourhood_id for neighbourhood_id, _ in neighbourhoods]
+            async with connection.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT NeighbourhoodId, Fingerprint FROM CovidAlerter.ParFingerprints "
+                    "WHERE NeighbourhoodId IN %s",
+                    (chunk_ids, )
+                )
+                stored_fingerprints = dict(await cursor.fetchall())
+                await cursor.execute(
+                    "SELECT Id FROM CovidAlerter.Neighbourhoods "
+                    "WHERE Id IN %s AND OutdoorArea IS NULL",
+                    (chunk_ids, )
+                )
+                missing_areas = {neighbourhood_id for neighbourhood_id, in await cursor.fetchall()}
+
+        # The queries of at most workers batches run at once, and a batch keeps its worker
+        # until its results are queued, so only a bounded number of results are in memory
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        semaphore = asyncio.Semaphore(workers)
+
+        async def query_batch(batch: list) -> None:
+            async with semaphore:
+                start_time = time.perf_counter()
+                fingerprints = {
+                    osm_id: hashlib.sha256((settings_hash + fingerprint).encode()).hexdigest()
+                    for osm_id, fingerprint in await fetch(
+                        osm_pool, "postgis.fingerprints",
+                        calculate_par.get_fingerprints_query(), batch)
+                }
+                changed = [osm_id for osm_id, fingerprint in fingerprints.items()
+                           if full or any(
+                               stored_fingerprints.get(neighbourhood_id) != fingerprint or
+                               neighbourhood_id in missing_areas
+                               for neighbourhood_id in neighbourhood_ids[osm_id])]
+                areas = []
+                if changed:
+                    areas = await fetch(osm_pool, "postgis.areas",
+                                        calculate_par.get_areas_query(), changed)
+                profiler.add_item("par.pipeline", f"{batch[0]}..{batch[-1]}",
+                                  time.perf_counter() - start_time)
+                await queue.put((fingerprints, areas))
+
+        async def write_batches() -> None:
+            async with connection.cursor() as cursor:
+                for _ in batches:
+                    fingerprints, areas = await queue.get()
+                    ratios = []
+                    new_fingerprints = []
+                    for osm_id, outdoor_area, house_area, commercial_area in areas:
+                        ratio = calculate_par.par_from_areas(outdoor_area, house_area,
+                                                             commercial_area)
+                        for neighbourhood_id in neighbourhood_ids[osm_id]:
+                            ratios.append((ratio, outdoor_area, house_area, commercial_area,
+                                           neighbourhood_id))
+                            new_fingerprints.append((neighbourhood_id, fingerprints[osm_id]))
+                    with profiler.stage("par.write"):
+                        await write_rows(cursor, RATIO_UPDATE, ratios)
+                        await write_rows(cursor, FINGERPRINT_UPSERT, new_fingerprints)
+
+        await asyncio.gather(write_batches(), *(query_batch(batch) for batch in batches))
+
+        # Commit the results
+        with profiler.stage("par.write"):
+            await connection.commit()
+    finally:
+        connection.close()
+        await osm_pool.close()
+
+
+async def run_scores(mark: int, last_id: int, date) -> None:
+    """Run the score pipeline (see run_score_pipeline)"""
+    # The reports are read on their own connection, as the server-side cursor holds it
+    read_connection = await aiomysql.connect(**get_main_arguments())
+    write_connection = await aiomysql.connect(**get_main_arguments(), autocommit=False)
+    try:
+        # Fetch the next batch of reports while the state machine processes the current one
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+        async def read_reports() -> None:
+            async with read_connection.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(to_pyformat(calculate_scores.get_stream_query(mark)),
+                                     {"mark": mark, "last_id": last_id})
+                while True:
+                    batch = await cursor.fetchmany(calculate_scores.STREAM_BATCH_SIZE)
+                    await queue.put(batch)
+                    if not batch:
+                        break
+
+        async def detect_stays() -> dict:
+            detector = calculate_scores.StayDetector()
+            while True:
+                batch = await queue.get()
+                if not batch:
+                    break
+                for row in batch:
+                    detector.add(*row)
+            return detector.finish()
+
+        _, counts = await asyncio.gather(read_reports(), detect_stays())
+
+        # Store the counts in batches, score the date again from all its counts and move the
+        # high-water mark in the same transaction
+        async with write_connection.cursor() as cursor:
+            params = {"date": date}
+            with profiler.stage("scores.write"):
+                if mark == 0:
+                    await cursor.execute(to_pyformat(calculate_scores.STAY_COUNTS_DELETE), params)
+                await write_rows(
+                    cursor,
+                    to_pyformat(calculate_scores.STAY_COUNTS_INSERT),
+                    [{"user_id": user_id, "neighbourhood_id": neighbourhood_id, "count": count,
+                      "date": date} for (user_id, neighbourhood_id), count in counts.items()]
+                )
+            with profiler.stage("scores.day"):
+                await cursor.execute(to_pyformat(calculate_scores.get_day_scores_query()), params)
+                await cursor.execute(CHECKPOINT_UPSERT,
+                                     (calculate_scores.CHECKPOINT_NAME, str(last_id)))
+            with profiler.stage("scores.commit"):
+                await write_connection.commit()
+    finally:
+        read_connection.close()
+        write_connection.close()
+
+
+async def fetch(pool: asyncpg.Pool, name: str, query: str, osm_ids: list) -> list:
+    """Run a PostGIS batch query (written for psycopg2) on a connection from the pool"""
+    async with pool.acquire() as connection:
+        start_time = time.perf_counter()
+        rows = await connection.fetch(query.replace("%s", "$1"), osm_ids)
+        profiler.record(name, time.perf_counter() - start_time, len(rows))
+    return [tuple(row) for row in rows]
+
+
+async def write_rows(cursor, statement: str, rows: list) -> None:
+    """Write the rows with an executemany per WRITE_BATCH_SIZE rows"""
+    for index in range(0, len(rows), WRITE_BATCH_SIZE):
+        await cursor.executemany(statement, rows[index:index + WRITE_BATCH_SIZE])
+
+
+def to_pyformat(query: str) -> str:
+    """Convert the named parameters of a SQL Alchemy query (:name) to the pyformat ones"""
+    return re.sub(r"(?<![:\w]):(\w+)", r"%(\1)s", query)
@@ -0,0 +1,332 @@
+"""Benchmark the PAR and score calculation on synthetic OSM data and reports
+
+WARNING: This drops and recreates the OSM tables of the PostGIS database and the tables of
+the MySQL database it is pointed at. The score queries use the CovidAlerter schema, so the
+MySQL database must be a local CovidAlerter database which can be thrown away.
+"""
+import time
+import json
+import random
+import itertools
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+import calculate_par
+import calculate_scores
+from model import Base, Neighbourhood, Report, User
+from profiling import profiler
+from connections import configure_main, configure_osm
+
+# The size of each neighbourhood (a square) in meters
+NEIGHBOURHOOD_SIZE = 1000
+# The number of buildings inside each neighbourhood
+BUILDINGS_PER_NEIGHBOURHOOD = 50
+# The chance of a building being a house
+HOUSE_CHANCE = 0.6
+# The chance of a non-house building being mapped as "building=yes" with a shop node inside
+SHOP_NODE_CHANCE = 0.5
+# The number of parks inside each neighbourhood (half of them have a playground inside)
+PARKS_PER_NEIGHBOURHOOD = 3
+# The longest stay of a synthetic user in a neighbourhood, in reports
+MAX_STAY_REPORTS = 12
+# The number of rows inserted at once
+INSERT_BATCH_SIZE = 10000
+# The slowdown compared to the previous result of the same scale that counts as a regression
+REGRESSION_RATIO = 1.2
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--postgis-dsn", required=True,
+                        help="The libpq connection string of the benchmark PostGIS database")
+    parser.add_argument("--mysql-url", required=True,
+                        help="The SQL Alchemy URL of the benchmark MySQL database")
+    parser.add_argument("--scale", type=int, default=1000,
+                        help="The number of neighbourhoods and of users (10^3 - 10^6)")
+    parser.add_argument("--hours", type=int, default=24,
+                        help="The number of hours of reports generated for each user")
+    parser.add_argument("--seed", type=int, default=0, help="The random seed")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of parallel PAR workers")
+    parser.add_argument("--score-engine", choices=calculate_scores.ENGINES, default="sql")
+    parser.add_argument("--results", default="benchmark_results.jsonl",
+                        help="The file the results are appended to")
+    parser.add_argument("--allow-remote", action="store_true",
+                        help="Allow running against databases which are not on localhost")
+    return parser.parse_args()
+
+
+def generate_osm(scale: int, rng: random.Random):
+    """Generate a city made of a grid of neighbourhoods with buildings, parks and shop nodes,
+    yielding the (polygons, points) rows of the osm2pgsql tables of the city and then of each
+    neighbourhood, with WKT geometries"""
+    columns = int(scale ** 0.5) or 1
+    rows = -(-scale // columns)
+    next_id = 1
+
+    def square(x: float, y: float, size: float) -> str:
+        return (f"POLYGON(({x} {y}, {x + size} {y}, {x + size} {y + size}, "
+                f"{x} {y + size}, {x} {y}))")
+
+    def polygon(osm_id: int, size: float, way: str, **tags) -> dict:
+        return dict(osm_id=osm_id, name=tags.get("name"), place=tags.get("place"),
+                    boundary=tags.get("boundary"), building=tags.get("building"),
+                    leisure=tags.get("leisure"), landuse=tags.get("landuse"),
+                    way_area=size * size, way=way)
+
+    # The city containing all the neighbourhoods
+    city_size = max(columns, rows) * NEIGHBOURHOOD_SIZE + 2
+    yield [polygon(-1, city_size, square(-1, -1, city_size),
+                   name="Benchmark City", boundary="administrative")], []
+
+    for index in range(scale):
+        left = (index % columns) * NEIGHBOURHOOD_SIZE
+        bottom = (index // columns) * NEIGHBOURHOOD_SIZE
+        polygons = []
+        points = []
+        polygons.append(polygon(-(index + 2), NEIGHBOURHOOD_SIZE,
+                                square(left, bottom, NEIGHBOURHOOD_SIZE),
+                                name=f"Neighbourhood {index}", place="neighbourhood",
+                                boundary="administrative"))
+
+        # Parks, some with a playground inside
+        for park in range(PARKS_PER_NEIGHBOURHOOD):
+            size = rng.uniform(100, 200)
+            x = left + rng.uniform(10, NEIGHBOURHOOD_SIZE - size - 10)
+            y = bottom + rng.uniform(10, NEIGHBOURHOOD_SIZE - size - 10)
+            polygons.append(polygon(next_id, size, square(x, y, size), leisure="park"))
+            next_id += 1
+            if park % 2 == 0:
+                polygons.append(polygon(next_id, 20, square(x + 10, y + 10, 20),
+                                        leisure="playground"))
+                next_id += 1
+
+        # Houses and commercial buildings
+        for _ in range(BUILDINGS_PER_NEIGHBOURHOOD):
+            size = rng.uniform(10, 30)
+            x = left + rng.uniform(1, NEIGHBOURHOOD_SIZE - size - 1)
+            y = bottom + rng.uniform(1, NEIGHBOURHOOD_SIZE - size - 1)
+            if rng.random() < HOUSE_CHANCE:
+                building = rng.choice(("house", "apartment", "detached"))
+            elif rng.random() < SHOP_NODE_CHANCE:
+                building = "yes"
+                points.append(dict(osm_id=next_id + 1, shop="convenience",
+                                   way=f"POINT({x + size / 2} {y + size / 2})"))
+            else:
+                building = rng.choice(("commercial", "retail", "office"))
+            polygons.append(polygon(next_id, size, square(x, y, size), building=building))
+            next_id += 2
+
+        yield polygons, points
+
+
+def load_osm(dsn: str, osm_rows) -> tuple:
+    """Load the synthetic OSM data (polygons, points) into the PostGIS database in batches
+    (recreating the tables) and get the number of (polygons, points)"""
+    with psycopg2.connect(dsn) as connection, connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        cursor.execute("DROP TABLE IF EXISTS planet_osm_polygon, planet_osm_point")
+        cursor.execute(
+            "CREATE TABLE planet_osm_polygon ("
+                "osm_id bigint, name text, place text, boundary text, building text, "
+                "leisure text, area text, tourism text, landuse text, \"natural\" text, "
+                "way_area real, way geometry(Geometry, 3857)"
+            ")"
+        )
+        cursor.execute(
+            "CREATE TABLE planet_osm_point ("
+                "osm_id bigint, amenity text, shop text, leisure text, office text, "
+                "tourism text, sport text, religion text, historic text, "
+                "way geometry(Point, 3857)"
+            ")"
+        )
+
+        def insert_polygons(rows: list) -> None:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO planet_osm_polygon (osm_id, name, place, boundary, building, "
+                "leisure, landuse, way_area, way) VALUES %s",
+                [(row["osm_id"], row["name"], row["place"], row["boundary"], row["building"],
+                  row["leisure"], row["landuse"], row["way_area"], row["way"]) for row in rows],
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, ST_GeomFromText(%s, 3857))",
+                page_size=INSERT_BATCH_SIZE
+            )
+
+        def insert_points(rows: list) -> None:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO planet_osm_point (osm_id, shop, way) VALUES %s",
+                [(row["osm_id"], row["shop"], row["way"]) for row in rows],
+                template="(%s, %s, ST_GeomFromText(%s, 3857))",
+                page_size=INSERT_BATCH_SIZE
+            )
+
+        # Only keep a batch of the generated rows in memory at once
+        polygon_batch = []
+        point_batch = []
+        polygon_count = point_count = 0
+        for polygons, points in osm_rows:
+            polygon_batch.extend(polygons)
+            point_batch.extend(points)
+            if len(polygon_batch) >= INSERT_BATCH_SIZE:
+                insert_polygons(polygon_batch)
+                polygon_count += len(polygon_batch)
+                polygon_batch = []
+            if len(point_batch) >= INSERT_BATCH_SIZE:
+                insert_points(point_batch)
+                point_count += len(point_batch)
+                point_batch = []
+        if polygon_batch:
+            insert_polygons(polygon_batch)
+            polygon_count += len(polygon_batch)
+        if point_batch:
+            insert_points(point_batch)
+            point_count += len(point_batch)
+
+        # The same indexes osm2pgsql creates
+        cursor.execute("CREATE INDEX ON planet_osm_polygon USING GIST (way)")
+        cursor.execute("CREATE INDEX ON planet_osm_polygon (osm_id)")
+        cursor.execute("CREATE INDEX ON planet_osm_point USING GIST (way)")
+        cursor.execute("ANALYZE planet_osm_polygon")
+        cursor.execute("ANALYZE planet_osm_point")
+    return polygon_count, point_count
+
+
+def generate_reports(user_count: int, neighbourhood_ids: list, hours: int, rng: random.Random):
+    """Generate a trail of reports every REPORT_MINUTES for each user, staying in a
+    neighbourhood for a random number of reports and then moving to another one
+    (yielding the rows one at a time)"""
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    step = timedelta(minutes=calculate_scores.REPORT_MINUTES)
+    report_count = hours * 60 // calculate_scores.REPORT_MINUTES
+    for user_id in range(1, user_count + 1):
+        neighbourhood_id = rng.choice(neighbourhood_ids)
+        stay = rng.randint(1, MAX_STAY_REPORTS)
+        for index in range(report_count):
+            if stay == 0:
+                neighbourhood_id = rng.choice(neighbourhood_ids)
+                stay = rng.randint(1, MAX_STAY_REPORTS)
+            yield {"UserId": user_id, "NeighbourhoodId": neighbourhood_id,
+                   "Timestamp": start + index * step}
+            stay -= 1
+
+
+def insert_rows(session, table, rows) -> int:
+    """Insert the rows (any iterable, only a batch is kept in memory at once) into the table
+    in batches and get their number"""
+    rows = iter(rows)
+    count = 0
+    while True:
+        batch = list(itertools.islice(rows, INSERT_BATCH_SIZE))
+        if not batch:
+            break
+        session.execute(table.insert(), batch)
+        count += len(batch)
+    session.commit()
+    return count
+
+
+def check_local(host: str) -> None:
+    """Make sure the benchmark is not run against a remote (eg. production) database"""
+    if host not in (None, "", "localhost", "127.0.0.1", "::1") and not host.startswith("/"):
+        raise SystemExit(f"Refusing to drop the tables of {host}, pass --allow-remote to do so")
+
+
+def get_commit() -> str:
+    """Get the current git commit (None outside a git repository)"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def check_regression(results_path: str, result: dict) -> None:
+    """Compare the result to the last result with the same parameters and print the regressions"""
+    previous = None
+    try:
+        with open(results_path, encoding="utf-8") as file:
+            for line in file:
+                old_result = json.loads(line)
+                if old_result["parameters"] == result["parameters"]:
+                    previous = old_result
+    except FileNotFoundError:
+        return
+    if previous is None:
+        return
+    for stage, stats in result["stages"].items():
+        old_stats = previous["stages"].get(stage)
+        if old_stats and stats["wall_time"] > old_stats["wall_time"] * REGRESSION_RATIO:
+            print(f"REGRESSION: {stage} took {stats['wall_time']:.2f}s, "
+                  f"was {old_stats['wall_time']:.2f}s on {previous['commit']}")
+
+
+def main():
+    """The main function"""
+    args = parse_args()
+    if not args.allow_remote:
+        check_local(sqlalchemy.engine.make_url(args.mysql_url).host)
+        check_local(psycopg2.extensions.parse_dsn(args.postgis_dsn).get("host"))
+    rng = random.Random(args.seed)
+
+    # Load the synthetic OSM data
+    polygon_count, point_count = load_osm(args.postgis_dsn, generate_osm(args.scale, rng))
+    configure_osm(dsn=args.postgis_dsn)
+
+    # Recreate the main database with the city as the only stored neighbourhood
+    # (the async engine connects through the connections module too)
+    configure_main(args.mysql_url)
+    engine = sqlalchemy.create_engine(args.mysql_url)
+    profiler.attach(engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Neighbourhood(Name="Benchmark City", OSMId="-1", IsRelation=True,
+                              LiveCount=0, IsBig=True))
+    session.commit()
+
+    profiler.reset()
+    start_time = time.perf_counter()
+    with profiler.stage("par"):
+        # Rebuild the prepared PAR tables from the new OSM data too
+        calculate_par.calculate(session, workers=args.workers, full=True, prepare=True)
+    par_time = time.perf_counter() - start_time
+
+    # Generate the reports in the neighbourhoods found by the PAR stage
+    neighbourhood_ids = [neighbourhood_id for (neighbourhood_id, ) in
+                         session.query(Neighbourhood.Id).filter(Neighbourhood.IsBig.is_(False))]
+    insert_rows(session, User.__table__, ({"Id": user_id}
+                                          for user_id in range(1, args.scale + 1)))
+    report_count = insert_rows(session, Report.__table__,
+                               generate_reports(args.scale, neighbourhood_ids, args.hours, rng))
+
+    start_time = time.perf_counter()
+    with profiler.stage("scores"):
+        calculate_scores.calculate(session, full=True, engine=args.score_engine)
+    scores_time = time.perf_counter() - start_time
+
+    result = {
+        "date": datetime.utcnow().isoformat(),
+        "commit": get_commit(),
+        "parameters": {"scale": args.scale, "hours": args.hours, "seed": args.seed,
+                       "workers": args.workers, "score_engine": args.score_engine},
+        "rows": {"polygons": polygon_count, "points": point_count, "reports": report_count},
+        "par_time": par_time,
+        "scores_time": scores_time,
+        "stages": profiler.stages,
+    }
+    print(f"PAR: {par_time:.2f}s, scores: {scores_time:.2f}s ({report_count} reports)")
+    check_regression(args.results, result)
+    with open(args.results, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
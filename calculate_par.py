@@ -1,9 +1,15 @@
 """Required functions to calculate the Person-Area Ratio for each of the Neighbourhoods"""
-import json
 import math
-import psycopg2
+import time
+import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm.session import Session
-from model import Neighbourhood
+from sqlalchemy.sql.expression import or_
+from model import ChildParents, Neighbourhood, ParFingerprint
+from profiling import profiler
+from checkpoints import get_checkpoint, set_checkpoint
+from connections import get_osm_connection, get_osm_cursor, get_osm_pool
 
 
 # PAR ratio constants
@@ -13,350 +19,821 @@ INDOOR_PAR_PER_POINT = 0.25
 
 HOUSE_PAR_PER_POINT = 0.3
 
-# OSM Postgre Database Connection
-with open("password.json", encoding="ascii") as file:
-    osm_db_password = json.load(file)["osm"]
-pgconn = psycopg2.connect(host="localhost", database="osm",
-                          user="mahan", password=osm_db_password)
+# The number of neighbourhoods whose areas are calculated in a single batch query
+BATCH_SIZE = 1000
+# The number of slowest batches whose neighbourhoods are timed one at a time again when
+# profiling the neighbourhoods (see Profiler.split_batches)
+SPLIT_BATCHES = 3
+
+# The number of neighbourhoods stored in a single transaction (along with the checkpoint)
+CHUNK_SIZE = 10000
+
+# The name of the checkpoint storing the last neighbourhood whose PAR is stored
+CHECKPOINT_NAME = "par"
+# The suffix of the checkpoint storing the PAR inputs of the last complete run (see get_inputs_hash)
+INPUTS_CHECKPOINT_SUFFIX = ".inputs"
+
+# Building tags which are considered to be houses
+# List generated by github copilot
+HOUSE_BUILDINGS_REGEX = (
+    "'^house$|"
+    "^apartment$|"
+    "^detached$|"
+    "^semidetached$|"
+    "^terraced$|^"
+    "condominium$|"
+    "^dormitory$|"
+    "^bungalow$|"
+    "^chalet$|"
+    "^cabin$|"
+    "^cottage$|"
+    "^duplex$|"
+    "^flat$|"
+    "^houseboat$|"
+    "^hut$|"
+    "^maisonette$|"
+    "^mansion$|"
+    "^mews$|"
+    "^mobile_home$|"
+    "^semidetached_house$|"
+    "^terraced_house$|"
+    "^retirement_home$|"
+    "^town_house$|"
+    "^villa$|"
+    "^yurt$'"
+)
+
+# Nodes (aliased as node) which mark a shop or another non residential place
+SHOP_NODE_FILTER = (
+    "( "
+        "node.amenity IS NOT NULL "
+        "OR "
+        "node.shop IS NOT NULL "
+        "OR "
+        "node.leisure IS NOT NULL "
+        "OR "
+        "node.office IS NOT NULL "
+        "OR "
+        "node.tourism IS NOT NULL "
+        "OR "
+        "node.sport IS NOT NULL "
+        "OR "
+        "node.religion IS NOT NULL "
+        "OR "
+        "node.historic IS NOT NULL "
+    ") "
+)
+
+# Ways (aliased as child) which are considered outdoor places
+OUTDOOR_FILTER = (
+    "("
+        # The child is not a building or boundary
+        "("
+            "child.building IS NULL "
+
+            "AND "
+
+            "child.boundary IS NULL "
+        ") "
+
+        "AND "
+
+        "("
+            # The leisure tag
+            "("
+                "child.leisure ~ "
+                    "'^park$|"
+                    "^beach_resort$|"
+                    "^dog_park$|"
+                    "^fishing$|"
+                    "^garden$|"
+                    "^marina$|"
+                    "^golf_course$|"
+                    "^miniature_golf$|"
+                    "^nature_reserve$|"
+                    "^outdoor_seating$|"
+                    "^pitch$|"
+                    "^playground$|"
+                    "^resort$|"
+                    "^slipway$|"
+                    "^sports_centre$|"
+                    "^sports_center$|"
+                    "^stadium$|"
+                    "^summer_camp$|"
+                    "^swimming_area$|"
+                    "^track$|^picinc$|"
+                    "^picnic_site$'"
+            ")"
+
+            "OR "
+
+            # The area tag
+            "("
+                "child.area='yes'"
+            ")"
+
+            "OR "
+
+            # The place tag
+            "("
+                "child.place ~ "
+                "'^farm$|"
+                "^square$'"
+            ")"
+
+            "OR "
 
-# OSM Postgre Database Cursor object
-cur = pgconn.cursor()
+            # The tourism tag
+            "("
+                "child.tourism ~ "
+                    "'^camp_pitch$|"
+                    "^camp_site$|"
+                    "^caravan_site$|"
+                    "^picnic_site$|"
+                    "^theme_park$|"
+                    "^zoo$'"
+            ")"
 
+            "OR "
+
+            # The landuse tag
+            "("
+                "child.landuse ~ "
+                    "'^$allotments|"
+                    "^farmland$|"
+                    "^farmyard$|"
+                    "^flowerbed$|"
+                    "^forest$|"
+                    "^meadow$|"
+                    "^orcahrd$|"
+                    "^vineyard$|"
+                    "^aquaculture$|"
+                    "^basin$|"
+                    "^resevoir$|"
+                    "^salt_pond$"
+                    "|^grass$|"
+                    "^greenfield|"
+                    "^plant_nursery$|"
+                    "^recreation_ground$|"
+                    "^religious$|"
+                    "^village_green$|"
+                    "^winter_sports$'"
+            ")"
 
-def calculate(session: Session):
-    """Calculate the Person-Area Ratio for each of the Neighbourhoods"""
-    # Get All stored neighbourhoods from the database
-    locations = session.query(Neighbourhood)
+            "OR "
 
-    for location in locations:
-        # Check if the location has any smaller administrative divisions
-        location.HasChilds = check_location_childs(location, session)
+            # The natureal tag
+            "("
+                # Anything that has the natural tag
+                "child.natural IS NOT NULL"
+            ")"
+
+        ")"
+    ")"
+)
+
+# Ways (aliased as child) which are administrative divisions (can be expanded for more tags)
+ADMINISTRATIVE_FILTER = (
+    "("
+    "child.place='neighbourhood' OR child.place='county' OR child.place='municipality' "
+    "OR child.boundary='administrative' OR child.boundary='postal_code'"
+    ")"
+)
+
+# The table storing the classified buildings (see prepare_buildings)
+BUILDINGS_TABLE = "par_buildings"
+
+# The table storing the merged outdoor places (see prepare_outdoors)
+OUTDOORS_TABLE = "par_outdoors"
+
+# The maximum number of vertices of each part of the merged outdoor places
+OUTDOOR_MAX_VERTICES = 256
+
+# The area of an outdoor place (aliased as outdoor) inside a neighbourhood (aliased as parent)
+OUTDOOR_AREA_INSIDE = (
+    "CASE "
+        "WHEN ST_Within(outdoor.way, parent.way) THEN outdoor.way_area "
+        "ELSE ST_Area(ST_Intersection(outdoor.way, parent.way)) "
+    "END"
+)
+
+
+def calculate(session: Session, batch: bool = True, workers: int = 1, full: bool = False,
+              prepare: bool = False, cache: str = None, limit: int = None,
+              shard: tuple = None, pipeline: bool = False):
+    """Calculate the Person-Area Ratio for each of the Neighbourhoods
+    (only the changed ones in batch mode, unless full is True, or all of them from a local
+    geometry cache directory without using PostGIS), in chunks resuming from the last run,
+    optionally only the first limit ones or the ones of a shard (index, count),
+    and optionally with the asyncio pipeline of async_pipeline"""
+    if cache is not None:
+        with profiler.stage("par.cache"):
+            calculate_cached(session, cache)
+        return
+
+    # The shards only calculate the PAR, the shared tables are prepared by a normal run
+    if shard is None:
+        # Classify the buildings and merge the outdoor places if they haven't been yet
+        # (or if asked to after an import)
+        with profiler.stage("par.prepare"):
+            if prepare or not table_exists(BUILDINGS_TABLE):
+                prepare_buildings()
+            if prepare or not table_exists(OUTDOORS_TABLE):
+                prepare_outdoors()
+
+        # Find the smaller administrative divisions of all the stored neighbourhoods
+        with profiler.stage("par.hierarchy"):
+            build_hierarchy(session)
+
+    # The inputs of every stored PAR only change when the prepared tables are rebuilt (or the
+    # constants change), until then only the neighbourhoods which were never calculated are
+    checkpoint_name = get_checkpoint_name(shard)
+    inputs_checkpoint_name = checkpoint_name + INPUTS_CHECKPOINT_SUFFIX
+    with profiler.stage("par.inputs"):
+        inputs_hash = get_inputs_hash()
+    new_only = not full and get_checkpoint(session, inputs_checkpoint_name) == inputs_hash
+
+    # Resume after the last neighbourhood stored by the previous run (of the same shard)
+    last_id = int(get_checkpoint(session, checkpoint_name, 0))
+    neighbourhoods = get_pending_neighbourhoods(session, last_id, limit, shard, new_only)
+
+    # Calculate the PAR of the neighbourhoods in chunks, storing each chunk and the
+    # checkpoint in their own transaction
+    for index in range(0, len(neighbourhoods), CHUNK_SIZE):
+        chunk = neighbourhoods[index:index + CHUNK_SIZE]
+        if pipeline:
+            # Overlap the PostGIS queries with the MySQL writes, the pipeline commits the
+            # chunk on its own connection and only the session stores the checkpoint below
+            # (so a chunk interrupted in between is calculated again)
+            # (only import the async drivers when they are used)
+            import async_pipeline
+            with profiler.stage("par.pipeline"):
+                async_pipeline.run_par_pipeline(chunk, workers, full)
+        elif batch:
+            # Calculate the PAR of all the neighbourhoods of the chunk at once
+            calculate_batch(session, chunk, workers, full)
+        else:
+            # Calculate the PAR of each of the neighbourhoods and store it in the database
+            with profiler.stage("par.neighbourhoods"):
+                for location in session.query(Neighbourhood).filter(
+                        Neighbourhood.Id.in_([neighbourhood_id
+                                              for neighbourhood_id, _ in chunk])):
+                    start_time = time.perf_counter()
+                    location.Ratio = calculate_par(location)
+                    profiler.add_item("par.neighbourhoods", location.OSMId,
+                                      time.perf_counter() - start_time)
+        with profiler.stage("par.write"):
+            set_checkpoint(session, checkpoint_name, chunk[-1][0])
+            session.commit()
+
+    # Start from the first neighbourhood again in the next run, unless the limit stopped
+    # this one early, all the neighbourhoods are now calculated from the current inputs
+    if limit is None or len(neighbourhoods) < limit:
+        set_checkpoint(session, checkpoint_name, 0)
+        set_checkpoint(session, inputs_checkpoint_name, inputs_hash)
         session.commit()
-        # Calculate the PAR for the location
-        if location.IsBig is False:
-            # Calculate the PAR and store it in the database
-            location.Ratio = calculate_par(location)
 
+def get_checkpoint_name(shard: tuple = None) -> str:
+    """Get the name of the checkpoint storing the progress of the specified shard"""
+    if shard is None:
+        return CHECKPOINT_NAME
+    index, count = shard
+    return f"{CHECKPOINT_NAME}.{index}/{count}"
+
+def get_pending_neighbourhoods(session: Session, last_id: int, limit: int = None,
+                               shard: tuple = None, new_only: bool = False) -> list:
+    """Get the small neighbourhoods after the specified one in order, optionally only the
+    first limit ones, the ones of a shard (index, count) or the ones which were never
+    calculated (without a fingerprint or areas) ([(Id, osm_id)])"""
+    query = session.query(Neighbourhood.Id, Neighbourhood.OSMId).filter(
+        Neighbourhood.IsBig.is_(False), Neighbourhood.Id > last_id)
+    if new_only:
+        query = query.outerjoin(
+            ParFingerprint, ParFingerprint.NeighbourhoodId == Neighbourhood.Id).filter(
+                or_(ParFingerprint.NeighbourhoodId.is_(None), Neighbourhood.OutdoorArea.is_(None)))
+    if shard is not None:
+        index, count = shard
+        query = query.filter(Neighbourhood.Id % count == index)
+    query = query.order_by(Neighbourhood.Id)
+    if limit is not None:
+        query = query.limit(limit)
+    return [(neighbourhood_id, int(osm_id)) for neighbourhood_id, osm_id in query]
+
+def calculate_batch(session: Session, neighbourhoods: list, workers: int = 1,
+                    full: bool = False):
+    """Calculate the Person-Area Ratio for the specified Neighbourhoods ([(Id, osm_id)]) using
+    set based queries, spread over the specified number of workers, skipping the ones whose
+    inputs haven't changed (the caller commits them)"""
+    # Map each OSM id to the neighbourhoods which are stored with it
+    neighbourhood_ids = {}
+    for neighbourhood_id, osm_id in neighbourhoods:
+        neighbourhood_ids.setdefault(osm_id, []).append(neighbourhood_id)
+
+    # Find the neighbourhoods whose PAR inputs have changed since the last run
+    settings_hash = get_settings_hash()
+    with profiler.stage("par.fingerprints"):
+        fingerprints = {osm_id: hashlib.sha256((settings_hash + fingerprint).encode()).hexdigest()
+                        for osm_id, fingerprint in
+                        run_batches(get_fingerprints, list(neighbourhood_ids), workers).items()}
+    chunk_ids = [neighbourhood_id for neighbourhood_id, _ in neighbourhoods]
+    stored_fingerprints = dict(session.query(ParFingerprint.NeighbourhoodId,
+                                             ParFingerprint.Fingerprint).filter(
+        ParFingerprint.NeighbourhoodId.in_(chunk_ids)))
+    # The areas are stored along with the ratios since they were added to the model, so the
+    # neighbourhoods which don't have them yet are calculated again too
+    missing_areas = {neighbourhood_id for neighbourhood_id, in
+                     session.query(Neighbourhood.Id).filter(
+                         Neighbourhood.Id.in_(chunk_ids), Neighbourhood.OutdoorArea.is_(None))}
+    osm_ids = [osm_id for osm_id, fingerprint in fingerprints.items()
+               if full or any(stored_fingerprints.get(neighbourhood_id) != fingerprint or
+                              neighbourhood_id in missing_areas
+                              for neighbourhood_id in neighbourhood_ids[osm_id])]
+
+    with profiler.stage("par.areas"):
+        areas = run_batches(get_areas, osm_ids, workers)
+
+    mappings = []
+    new_fingerprints = []
+    changed_fingerprints = []
+    for osm_id, (outdoor_area, house_area, commercial_area) in areas.items():
+        columns = get_par_columns(outdoor_area, house_area, commercial_area)
+        for neighbourhood_id in neighbourhood_ids[osm_id]:
+            mappings.append({"Id": neighbourhood_id, **columns})
+            fingerprint = {"NeighbourhoodId": neighbourhood_id,
+                           "Fingerprint": fingerprints[osm_id]}
+            if neighbourhood_id in stored_fingerprints:
+                changed_fingerprints.append(fingerprint)
+            else:
+                new_fingerprints.append(fingerprint)
+
+    # Store all the ratios and their fingerprints with bulk statements
+    with profiler.stage("par.write"):
+        session.bulk_update_mappings(Neighbourhood, mappings)
+        session.bulk_update_mappings(ParFingerprint, changed_fingerprints)
+        session.bulk_insert_mappings(ParFingerprint, new_fingerprints)
+
+def get_neighbourhood_ids(session: Session) -> dict:
+    """Map the OSM id of each of the small neighbourhoods to the neighbourhoods which are
+    stored with it ({osm_id: [Id]})"""
+    neighbourhood_ids = {}
+    for neighbourhood_id, osm_id in session.query(Neighbourhood.Id, Neighbourhood.OSMId).filter(
+            Neighbourhood.IsBig.is_(False)):
+        neighbourhood_ids.setdefault(int(osm_id), []).append(neighbourhood_id)
+    return neighbourhood_ids
+
+def dump_cache(session: Session, directory: str) -> None:
+    """Dump the geometries needed to calculate the PAR of all the neighbourhoods to a local
+    cache directory, to calculate it later without PostGIS (see par_cache)"""
+    # Only import the cache dependencies (NumPy and Shapely) when they are used
+    import par_cache
+    with profiler.stage("par.dump_cache"):
+        par_cache.dump(directory, list(get_neighbourhood_ids(session)),
+                       get_osm_connection(),
+                       BUILDINGS_TABLE, OUTDOORS_TABLE)
+
+def calculate_cached(session: Session, directory: str) -> None:
+    """Calculate the Person-Area Ratio for all the Neighbourhoods from a local geometry cache"""
+    import par_cache
+    neighbourhood_ids = get_neighbourhood_ids(session)
+    mappings = []
+    for osm_id, (outdoor_area, house_area, commercial_area) in \
+            par_cache.get_areas(directory).items():
+        columns = get_par_columns(outdoor_area, house_area, commercial_area)
+        mappings.extend({"Id": neighbourhood_id, **columns}
+                        for neighbourhood_id in neighbourhood_ids.get(osm_id, []))
+
+    with profiler.stage("par.write"):
+        session.bulk_update_mappings(Neighbourhood, mappings)
         session.commit()
 
+def run_batches(query_function, osm_ids: list, workers: int = 1) -> dict:
+    """Run a batch query function over all the specified OSM ids, spread over the
+    specified number of workers, and merge the results"""
+    # Split the neighbourhoods so that every worker gets at least one batch
+    batch_size = max(1, min(BATCH_SIZE, math.ceil(len(osm_ids) / workers)))
+    batches = [osm_ids[index:index + batch_size] for index in range(0, len(osm_ids), batch_size)]
+
+    def run_batch(batch: list) -> dict:
+        # Run a single batch and record the time spent on it
+        start_time = time.perf_counter()
+        if workers > 1:
+            result = run_pooled(query_function, batch)
+        else:
+            result = query_function(batch)
+        elapsed = time.perf_counter() - start_time
+        profiler.add_item(f"par.{query_function.__name__}", f"{batch[0]}..{batch[-1]}", elapsed)
+        timings.append((elapsed, batch))
+        return result
+
+    timings = []
+
+    if workers > 1:
+        # Each worker thread runs its queries on its own connection from the pool,
+        # the threads only wait on PostGIS so the GIL is not a bottleneck
+        get_osm_pool(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_batch, batches))
+    else:
+        results = [run_batch(batch) for batch in batches]
+
+    # Time the neighbourhoods of the slowest batches one at a time, to find the slow ones
+    if profiler.split_batches:
+        timings.sort(key=lambda timing: timing[0], reverse=True)
+        for _, batch in timings[:SPLIT_BATCHES]:
+            for osm_id in batch:
+                start_time = time.perf_counter()
+                query_function([osm_id])
+                profiler.add_item(f"par.{query_function.__name__}.neighbourhoods", osm_id,
+                                  time.perf_counter() - start_time)
+
+    # Merge the results of all the workers
+    merged = {}
+    for result in results:
+        merged.update(result)
+    return merged
+
 def calculate_par(loc: Neighbourhood) -> float:
-    """Calculate the Person-Area Ratio for the specified location"""
-    outdoor_area = math.floor(get_outdoors(loc))
-    house_area = math.floor(get_indoors(loc)[0])
-    commercial_area = math.floor(get_indoors(loc)[1])
+    """Calculate the Person-Area Ratio for the specified location (storing its areas on it)"""
+    house_area, commercial_area = get_indoors(loc)
+    outdoor_area = get_outdoors(loc)
+    loc.OutdoorArea = outdoor_area
+    loc.HouseArea = house_area
+    loc.CommercialArea = commercial_area
+    return par_from_areas(outdoor_area, house_area, commercial_area)
+
+def get_par_columns(outdoor_area: float, house_area: float, commercial_area: float) -> dict:
+    """Get the Neighbourhood columns storing the PAR and the areas it is calculated from"""
+    return {"Ratio": par_from_areas(outdoor_area, house_area, commercial_area),
+            "OutdoorArea": float(outdoor_area or 0), "HouseArea": float(house_area or 0),
+            "CommercialArea": float(commercial_area or 0)}
+
+def par_from_areas(outdoor_area: float, house_area: float, commercial_area: float) -> float:
+    """Calculate the Person-Area Ratio from the area of each of the place types
+    (None if the neighbourhood has none of them)"""
+    outdoor_area = math.floor(outdoor_area or 0)
+    house_area = math.floor(house_area or 0)
+    commercial_area = math.floor(commercial_area or 0)
+    total_area = outdoor_area + commercial_area + house_area
+    if total_area == 0:
+        return None
     par = ( OUTDOOR_PAR_PER_POINT * outdoor_area +
             INDOOR_PAR_PER_POINT * commercial_area +
             HOUSE_PAR_PER_POINT * house_area
-          ) / (outdoor_area + commercial_area + house_area)
+          ) / total_area
     return par
 
-def get_indoors(loc: Neighbourhood) -> tuple:
-    """Get the sum of all indoor places' area in a neighbourhood (houses_area, commercial_area)"""
-    osm_id = loc.OSMId
-    query = (
-        # Select all the buildings inside the specified location
-        "WITH all_buildings AS ( "
-            "SELECT * "
-            "FROM planet_osm_polygon AS place "
-            "WHERE "
-                # The place is inside our neighbourhood
-                "ST_Within(place.way, "
-                    "("
-                        "SELECT way FROM planet_osm_polygon WHERE osm_id = %s"
-                    ")"
-                ") "
-                # And the place is a building
-                "AND place.building IS NOT NULL "
+def run_pooled(query_function, osm_ids: list) -> dict:
+    """Run a batch query function using a connection from the pool"""
+    pool = get_osm_pool()
+    connection = pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            return query_function(osm_ids, cursor)
+    finally:
+        pool.putconn(connection)
+
+def get_settings_hash() -> str:
+    """Get a hash of the constants and filters which affect the PAR"""
+    settings = (OUTDOOR_PAR_PER_POINT, INDOOR_PAR_PER_POINT, HOUSE_PAR_PER_POINT,
+                HOUSE_BUILDINGS_REGEX, SHOP_NODE_FILTER, OUTDOOR_FILTER)
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+def get_inputs_hash(cursor=None) -> str:
+    """Get a hash of the constants and of the generation of the prepared tables, which is
+    stored as their comment each time they are rebuilt"""
+    cursor = cursor or get_osm_cursor()
+    cursor.execute(
+        "SELECT obj_description(to_regclass(%s), 'pg_class'), "
+        "obj_description(to_regclass(%s), 'pg_class')",
+        (BUILDINGS_TABLE, OUTDOORS_TABLE)
+    )
+    return hashlib.sha256((get_settings_hash() + repr(cursor.fetchone())).encode()).hexdigest()
+
+def get_fingerprints(osm_ids: list, cursor=None) -> dict:
+    """Get a hash of the boundary and of the PAR inputs inside each of the specified
+    neighbourhoods (the merged outdoor places and the classified buildings)
+    ({osm_id: fingerprint})"""
+    cursor = cursor or get_osm_cursor()
+
+    # Run the query and return the result
+    profiler.execute(cursor, "postgis.fingerprints", get_fingerprints_query(), (osm_ids, ))
+    # Result row format:
+    # (OSMId, Fingerprint)
+    return dict(cursor.fetchall())
+
+def get_fingerprints_query() -> str:
+    """Get the query hashing the neighbourhoods whose OSM ids are passed as its only parameter
+    (OSMId, Fingerprint)"""
+    return (
+        # Select the boundaries of all the requested neighbourhoods
+        "WITH targets AS ( "
+            "SELECT DISTINCT ON (target.osm_id) target.osm_id, target.way "
+            "FROM planet_osm_polygon AS target "
+            "WHERE target.osm_id = ANY(%s) "
+        ") "
+
+        "SELECT target.osm_id, md5( "
+            # The boundary geometry
+            "md5(ST_AsEWKB(target.way)) "
+            "|| "
+            # The geometry of the merged outdoor places inside (or partly inside) the
+            # neighbourhood, found like get_areas does
+            "COALESCE(( "
+                "SELECT string_agg(place.hash, '' ORDER BY place.hash) "
+                "FROM ("
+                    "SELECT md5(ST_AsEWKB(outdoor.way)) AS hash "
+                    f"FROM {OUTDOORS_TABLE} AS outdoor "
+                    "WHERE ST_Intersects(outdoor.way, target.way)"
+                ") AS place"
+            "), '') "
+            "|| "
+            # The class and area of the classified buildings inside the neighbourhood
+            "COALESCE(( "
+                "SELECT string_agg(place.hash, '' ORDER BY place.hash) "
+                "FROM ("
+                    "SELECT md5(building.osm_id || building.building_class || building.way_area) "
+                        "AS hash "
+                    f"FROM {BUILDINGS_TABLE} AS building "
+                    "WHERE ST_Within(building.way, target.way)"
+                ") AS place"
+            "), '') "
+        ") "
+        "FROM targets AS target"
+    )
+
+def get_areas(osm_ids: list, cursor=None) -> dict:
+    """Get the area of each place type inside the specified neighbourhoods
+    ({osm_id: (outdoor_area, houses_area, commercial_area)})"""
+    cursor = cursor or get_osm_cursor()
+
+    # Run the query and return the result
+    profiler.execute(cursor, "postgis.areas", get_areas_query(), (osm_ids, ))
+    # Result row format:
+    # (OSMId, Outdoor area, Houses area, Commercial area)
+    return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+def get_areas_query() -> str:
+    """Get the query summing the areas inside the neighbourhoods whose OSM ids are passed as its
+    only parameter (OSMId, Outdoor area, Houses area, Commercial area)"""
+    return (
+        # Select the boundaries of all the requested neighbourhoods
+        "WITH targets AS ( "
+            "SELECT DISTINCT ON (target.osm_id) "
+                "target.osm_id, target.way, target.way_area "
+            "FROM planet_osm_polygon AS target "
+            "WHERE target.osm_id = ANY(%s) "
         "), "
-        "houses AS ( "
-            # Select all the houses inside the neighbourhood
-            "SELECT house.osm_id, house.way_area "
-            "FROM all_buildings AS house "
-            # List generated by github copilot
-            "WHERE house.building ~"
-                "'^house$|"
-                "^apartment$|"
-                "^detached$|"
-                "^semidetached$|"
-                "^terraced$|^"
-                "condominium$|"
-                "^dormitory$|"
-                "^bungalow$|"
-                "^chalet$|"
-                "^cabin$|"
-                "^cottage$|"
-                "^duplex$|"
-                "^flat$|"
-                "^houseboat$|"
-                "^hut$|"
-                "^maisonette$|"
-                "^mansion$|"
-                "^mews$|"
-                "^mobile_home$|"
-                "^semidetached_house$|"
-                "^terraced_house$|"
-                "^retirement_home$|"
-                "^town_house$|"
-                "^villa$|"
-                "^yurt$' "
-            "OR "
-                "( "
-                    # In OSM, some shops are mapped as a building with "building=yes" tag, and
-                    # a node inside them with more information about the shop.
-                    # Check for shop nodes inside the building
-                    "SELECT COUNT(node.osm_id) FROM planet_osm_point AS node "
-                    "WHERE "
-                        "ST_Within(node.way, house.way) "
-                        "AND "
-                        "( "
-                            "node.amenity IS NOT NULL "
-                            "OR "
-                            "node.shop IS NOT NULL "
-                            "OR "
-                            "node.leisure IS NOT NULL "
-                            "OR "
-                            "node.office IS NOT NULL "
-                            "OR "
-                            "node.tourism IS NOT NULL "
-                            "OR "
-                            "node.sport IS NOT NULL "
-                            "OR "
-                            "node.religion IS NOT NULL "
-                            "OR "
-                            "node.historic IS NOT NULL "
-                        ") "
-                ") = 0 "
+        "outdoors AS ( "
+            # Sum the part of the merged outdoor places inside each of the neighbourhoods
+            "SELECT parent.osm_id AS target_id, "
+                f"SUM({OUTDOOR_AREA_INSIDE}) AS area "
+            "FROM targets AS parent "
+            f"INNER JOIN {OUTDOORS_TABLE} AS outdoor "
+            "ON ST_Intersects(outdoor.way, parent.way) "
+            "GROUP BY parent.osm_id"
+        "), "
+        "buildings AS ( "
+            # Select all the classified buildings inside each of the neighbourhoods
+            "SELECT parent.osm_id AS target_id, building.way_area AS way_area, "
+                "building.building_class = 'house' AS is_house "
+            "FROM targets AS parent "
+            f"INNER JOIN {BUILDINGS_TABLE} AS building "
+            "ON ST_Within(building.way, parent.way)"
         "), "
-        "commercials AS ( "
-            # Select all the commercial buildings inside the neighbourhood
-            # Any building that is not a house is a commercial building
-            "SELECT commercial.osm_id, commercial.way_area "
-            "FROM all_buildings AS commercial "
-            "WHERE commercial.osm_id NOT IN (SELECT houses.osm_id FROM houses) "
+        "indoors AS ( "
+            "SELECT target_id, "
+                "SUM(way_area) FILTER (WHERE is_house) AS house_area, "
+                "SUM(way_area) FILTER (WHERE NOT is_house) AS commercial_area "
+            "FROM buildings "
+            "GROUP BY target_id"
         ") "
 
-        "SELECT SUM(houses.way_area), SUM(commercials.way_area) FROM houses, commercials"
+        "SELECT target.osm_id, "
+            "COALESCE(outdoors.area, 0), "
+            "COALESCE(indoors.house_area, 0), "
+            "COALESCE(indoors.commercial_area, 0) "
+        "FROM targets AS target "
+        "LEFT JOIN outdoors ON outdoors.target_id = target.osm_id "
+        "LEFT JOIN indoors ON indoors.target_id = target.osm_id"
+    )
+
+def get_indoors(loc: Neighbourhood) -> tuple:
+    """Get the sum of all indoor places' area in a neighbourhood (houses_area, commercial_area)"""
+    osm_id = loc.OSMId
+    query = (
+        # Sum the classified buildings inside the specified location
+        "SELECT "
+            "COALESCE(SUM(building.way_area) FILTER (WHERE building.building_class = 'house'), 0), "
+            "COALESCE(SUM(building.way_area) "
+                "FILTER (WHERE building.building_class = 'commercial'), 0) "
+        f"FROM {BUILDINGS_TABLE} AS building "
+        "WHERE "
+            # The building is inside our neighbourhood
+            "ST_Within(building.way, "
+                "("
+                    "SELECT way FROM planet_osm_polygon WHERE osm_id = %s"
+                ")"
+            ")"
     )
 
     # Run the query and return the result
-    cur.execute(query, (osm_id, ))
-    result = cur.fetchone()
-    return result or tuple([0])
+    cursor = get_osm_cursor()
+    profiler.execute(cursor, "postgis.indoors", query, (osm_id, ))
+    result = cursor.fetchone()
+    return result or (0, 0)
+
+def prepare_buildings(cursor=None) -> None:
+    """Classify every building as a house or a commercial building once, and store them in an
+    indexed table (needs to be rerun after each OSM import)"""
+    cursor = cursor or get_osm_cursor()
+    query = (
+        f"DROP TABLE IF EXISTS {BUILDINGS_TABLE}; "
+        f"CREATE TABLE {BUILDINGS_TABLE} AS "
+        # Find all the buildings with a shop node inside them with a single spatial join.
+        # In OSM, some shops are mapped as a building with "building=yes" tag, and
+        # a node inside them with more information about the shop.
+        "WITH shops AS ( "
+            "SELECT DISTINCT building.osm_id "
+            "FROM planet_osm_point AS node "
+            "INNER JOIN planet_osm_polygon AS building "
+            "ON ST_Within(node.way, building.way) "
+            "WHERE building.building IS NOT NULL "
+            f"AND {SHOP_NODE_FILTER}"
+        ") "
+        "SELECT building.osm_id, "
+            # A building is a house if it is tagged as one, or has no shop nodes inside,
+            # any building that is not a house is a commercial building
+            "CASE "
+                f"WHEN building.building ~ {HOUSE_BUILDINGS_REGEX} OR shops.osm_id IS NULL "
+                "THEN 'house' "
+                "ELSE 'commercial' "
+            "END AS building_class, "
+            "building.way_area, building.way "
+        "FROM planet_osm_polygon AS building "
+        "LEFT JOIN shops ON shops.osm_id = building.osm_id "
+        "WHERE building.building IS NOT NULL; "
+        f"CREATE INDEX ON {BUILDINGS_TABLE} USING GIST (way); "
+        # Mark the new generation of the table (see get_inputs_hash)
+        f"COMMENT ON TABLE {BUILDINGS_TABLE} IS '{uuid.uuid4().hex}'; "
+        f"ANALYZE {BUILDINGS_TABLE}"
+    )
+    profiler.execute(cursor, "postgis.prepare_buildings", query, explain=False)
+    cursor.connection.commit()
+
+def table_exists(name: str, cursor=None) -> bool:
+    """Returns True if the specified table exists in the OSM database"""
+    cursor = cursor or get_osm_cursor()
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name, ))
+    return cursor.fetchone()[0]
 
 def get_outdoors(loc: Neighbourhood) -> float:
     """Get the sum all outdoor places' area in a neighbourhood"""
     osm_id = loc.OSMId
 
     query = (
-        # Declare a temp table for the parents, to then calculate the sum from it
-        "WITH parents AS ( "
-            # Declare a temp table for the results with duplicates on having childs
-            "WITH duplicated_results AS ( "
-            # Declare a temp table for the results
-                "WITH results AS ( "
-
-                    # Select all the locations that are inside our neighbourhood
-                    "SELECT child.osm_id as osm_id, child.way_area as way_area, child.way as way "
-                    "FROM planet_osm_polygon AS child "
-                    "INNER JOIN planet_osm_polygon AS parent "
-                    "ON ST_Within(child.way, parent.way) "
-
-                    "WHERE "
-                    "("
-                        # The child is not a building or boundary
-                        "("
-                            "child.building IS NULL "
-
-                            "AND "
-
-                            "child.boundary IS NULL "
-                        ") "
-
-                        "AND "
-
-                        "("
-                            # The leisure tag
-                            "("
-                                "child.leisure ~ "
-                                    "'^park$|"
-                                    "^beach_resort$|"
-                                    "^dog_park$|"
-                                    "^fishing$|"
-                                    "^garden$|"
-                                    "^marina$|"
-                                    "^golf_course$|"
-                                    "^miniature_golf$|"
-                                    "^nature_reserve$|"
-                                    "^outdoor_seating$|"
-                                    "^pitch$|"
-                                    "^playground$|"
-                                    "^resort$|"
-                                    "^slipway$|"
-                                    "^sports_centre$|"
-                                    "^sports_center$|"
-                                    "^stadium$|"
-                                    "^summer_camp$|"
-                                    "^swimming_area$|"
-                                    "^track$|^picinc$|"
-                                    "^picnic_site$'"
-                            ")"
-
-                            "OR "
-
-                            # The area tag
-                            "("
-                                "child.area='yes'"
-                            ")"
-
-                            "OR "
-
-                            # The place tag
-                            "("
-                                "child.place ~ "
-                                "'^farm$|"
-                                "^square$'"
-                            ")"
-
-                            "OR "
-
-                            # The tourism tag
-                            "("
-                                "child.tourism ~ "
-                                    "'^camp_pitch$|"
-                                    "^camp_site$|"
-                                    "^caravan_site$|"
-                                    "^picnic_site$|"
-                                    "^theme_park$|"
-                                    "^zoo$'"
-                            ")"
-
-                            "OR "
-
-                            # The landuse tag
-                            "("
-                                "child.landuse ~ "
-                                    "'^$allotments|"
-                                    "^farmland$|"
-                                    "^farmyard$|"
-                                    "^flowerbed$|"
-                                    "^forest$|"
-                                    "^meadow$|"
-                                    "^orcahrd$|"
-                                    "^vineyard$|"
-                                    "^aquaculture$|"
-                                    "^basin$|"
-                                    "^resevoir$|"
-                                    "^salt_pond$"
-                                    "|^grass$|"
-                                    "^greenfield|"
-                                    "^plant_nursery$|"
-                                    "^recreation_ground$|"
-                                    "^religious$|"
-                                    "^village_green$|"
-                                    "^winter_sports$'"
-                            ")"
-
-                            "OR "
-
-                            # The natureal tag
-                            "("
-                                # Anything that has the natural tag
-                                "child.natural IS NOT NULL"
-                            ")"
-
-                        ")"
-                    ")"
-
-                    # Specify the neighbourhood id
-                    "AND "
-
-                    "parent.osm_id = %s "
-
-                    "AND "
-
-                    # Filter out the parent from the results
-                    "child.osm_id!=parent.osm_id "
-
-                    "AND "
-
-                    "child.way_area!=parent.way_area"
-                ") "
-
-                # Filter out ways that are inside another way
-                # (eg. playground inside a sorrounding park)
-
-                # Store parents and childs in the temp table
-                "SELECT parent.osm_id AS parent_id, "
-                    "child.osm_id AS child_id, "
-                    "parent.way_area AS parent_area "
-                "FROM results AS parent "
-                "LEFT JOIN results AS child "
-                "ON ( "
-                    "ST_Within(child.way, parent.way) "
-                    "AND child.osm_id!=parent.osm_id "
-                    "AND child.way_area!=parent.way_area "
-                ") "
-            ") "
-
-            # Select parents that are not in the childs list (that are not childs of anything else)
-            "SELECT DISTINCT ON (parent_id) parent_area FROM duplicated_results "
-            "WHERE parent_id NOT IN "
-            "( "
-                "SELECT child_id FROM duplicated_results WHERE child_id IS NOT NULL"
-            ") "
+        # Select the boundary of our neighbourhood
+        "WITH parent AS ( "
+            "SELECT way FROM planet_osm_polygon WHERE osm_id = %s"
         ") "
 
-        "SELECT SUM(parents.parent_area) FROM parents"
+        # Sum the part of the merged outdoor places inside it
+        f"SELECT COALESCE(SUM({OUTDOOR_AREA_INSIDE}), 0) "
+        f"FROM parent, {OUTDOORS_TABLE} AS outdoor "
+        "WHERE ST_Intersects(outdoor.way, parent.way)"
     )
 
     # Run the query and return the result
-    cur.execute(query, (osm_id, ))
-    result = cur.fetchone()
+    cursor = get_osm_cursor()
+    profiler.execute(cursor, "postgis.outdoors", query, (osm_id, ))
+    result = cursor.fetchone()
     return result[0] if result is not None else 0
 
-
-def check_location_childs(loc: Neighbourhood, db_session: Session) -> bool:
-    """Returns True if the specified location has smaller administrative divisions inside"""
-    osm_id = loc.OSMId
-
+def prepare_outdoors(cursor=None) -> None:
+    """Merge all the outdoor places into an indexed table of non overlapping areas
+    (needs to be rerun after each OSM import)"""
+    cursor = cursor or get_osm_cursor()
     query = (
-        # Select the number of smaller divisions that are inside our location
-        "SELECT child.name, child.osm_id, child.place FROM planet_osm_polygon AS child "
-        "INNER JOIN planet_osm_polygon AS parent "
-        "ON ST_Within(child.way, parent.way) "
-        # Only childs which are administrative divisions (can be expanded for more tags)
-        "WHERE ("
-        "child.place='neighbourhood' OR child.place='county' OR child.place='municipality' "
-        "OR child.boundary='administrative' OR child.boundary='postal_code'"
+        f"DROP TABLE IF EXISTS {OUTDOORS_TABLE}; "
+        f"CREATE TABLE {OUTDOORS_TABLE} AS "
+        # Group the outdoor places which touch or overlap each other
+        # (eg. a playground inside a sorrounding park, or two parks sharing a part)
+        "WITH clusters AS ( "
+            "SELECT child.way, ST_ClusterDBSCAN(child.way, 0, 1) OVER () AS cluster_id "
+            "FROM planet_osm_polygon AS child "
+            f"WHERE {OUTDOOR_FILTER}"
+        "), "
+        # Merge each group, so the shared areas are only counted once
+        "merged AS ( "
+            "SELECT ST_Union(way) AS way FROM clusters GROUP BY cluster_id"
         ") "
-        "AND "
-        "parent.osm_id = %s "
-        "AND "
-        # Filter out the parent from the results
+        # Split the merged areas into small parts, to keep the index and intersections fast
+        "SELECT parts.way, ST_Area(parts.way) AS way_area "
+        "FROM ("
+            f"SELECT ST_Subdivide(way, {OUTDOOR_MAX_VERTICES}) AS way FROM merged"
+        ") AS parts; "
+        f"CREATE INDEX ON {OUTDOORS_TABLE} USING GIST (way); "
+        # Mark the new generation of the table (see get_inputs_hash)
+        f"COMMENT ON TABLE {OUTDOORS_TABLE} IS '{uuid.uuid4().hex}'; "
+        f"ANALYZE {OUTDOORS_TABLE}"
+    )
+    profiler.execute(cursor, "postgis.prepare_outdoors", query, explain=False)
+    cursor.connection.commit()
+
+
+def build_hierarchy(session: Session):
+    """Find the smaller administrative divisions of all the Neighbourhoods, store the new ones,
+    and link every division to all the divisions which contain it"""
+    stored_ids = dict((osm_id, neighbourhood_id) for neighbourhood_id, osm_id in
+                      session.query(Neighbourhood.Id, Neighbourhood.OSMId))
+    divisions, pairs, areas = get_hierarchy([int(osm_id) for osm_id in stored_ids])
+
+    # Store the divisions which are not stored yet
+    session.bulk_insert_mappings(Neighbourhood, [
+        {"Name": name, "OSMId": str(osm_id), "IsRelation": str(osm_id).startswith('-'),
+         "LiveCount": 0, "IsBig": place is None, "Area": areas.get(osm_id)}
+        for osm_id, (name, place) in divisions.items() if str(osm_id) not in stored_ids
+    ])
+    session.flush()
+    stored_ids = dict((osm_id, neighbourhood_id) for neighbourhood_id, osm_id in
+                      session.query(Neighbourhood.Id, Neighbourhood.OSMId))
+
+    # Store the parent-child relationships which are not stored yet
+    stored_pairs = {tuple(pair) for pair in
+                    session.query(ChildParents.ParentsId, ChildParents.ChildsId)}
+    pair_ids = {(stored_ids[str(parent_id)], stored_ids[str(child_id)])
+                for parent_id, child_id in pairs}
+    session.bulk_insert_mappings(ChildParents, [
+        {"ParentsId": parent_id, "ChildsId": child_id}
+        for parent_id, child_id in pair_ids - stored_pairs
+    ])
+
+    # Store whether each of the neighbourhoods has childs, and the area of the ones in the
+    # hierarchy
+    parent_ids = {parent_id for parent_id, _ in pair_ids}
+    session.bulk_update_mappings(Neighbourhood, [
+        {"Id": neighbourhood_id, "HasChilds": neighbourhood_id in parent_ids,
+         **({"Area": areas[int(osm_id)]} if int(osm_id) in areas else {})}
+        for osm_id, neighbourhood_id in stored_ids.items()
+    ])
+    session.commit()
+
+def get_hierarchy(osm_ids: list, cursor=None) -> tuple:
+    """Get all the administrative divisions inside the specified locations and the
+    containment relationships between them and the locations, and the area of all of them
+    ({osm_id: (name, place tag)}, [(parent_osm_id, child_osm_id)], {osm_id: area})"""
+    cursor = cursor or get_osm_cursor()
+    query = (
+        # Select the boundaries of all the requested locations
+        "WITH roots AS ( "
+            "SELECT DISTINCT ON (root.osm_id) root.osm_id, root.way, root.way_area "
+            "FROM planet_osm_polygon AS root "
+            "WHERE root.osm_id = ANY(%s) "
+        "), "
+        "divisions AS ( "
+            # Select the smaller divisions that are inside any of our locations
+            "SELECT DISTINCT ON (child.osm_id) "
+                "child.osm_id, child.name, child.place, child.way, child.way_area "
+            "FROM planet_osm_polygon AS child "
+            "INNER JOIN roots AS parent "
+            "ON ST_Within(child.way, parent.way) "
+            f"WHERE {ADMINISTRATIVE_FILTER} "
+            "AND "
+            # Filter out the parent from the results
+            "child.osm_id!=parent.osm_id "
+            "AND "
+            "child.way_area!=parent.way_area"
+        "), "
+        "nodes AS ( "
+            # The locations and their divisions can all be parents
+            "SELECT DISTINCT ON (osm_id) osm_id, way, way_area FROM ( "
+                "SELECT osm_id, way, way_area FROM roots "
+                "UNION ALL "
+                "SELECT osm_id, way, way_area FROM divisions"
+            ") AS all_nodes"
+        ") "
+
+        # Select every division along with all the locations and divisions which contain it
+        "SELECT parent.osm_id, child.osm_id, child.name, child.place, "
+            "parent.way_area, child.way_area "
+        "FROM divisions AS child "
+        "INNER JOIN nodes AS parent "
+        "ON ST_Within(child.way, parent.way) "
+        "WHERE "
         "child.osm_id!=parent.osm_id "
         "AND "
         "child.way_area!=parent.way_area"
     )
 
-    haschilds: bool
-
     # Run the query and return the result
-    cur.execute(query, (osm_id, ))
-    result = cur.fetchall()
-
+    profiler.execute(cursor, "postgis.hierarchy", query, (osm_ids, ))
     # Result row format:
-    # (Name, OSMId, Place tag)
-    if len(result) > 0:
-        for row in result:
-            child = Neighbourhood(Name=row[0], OSMId=str(row[1]),
-                                  IsRelation=str(row[1]).startswith('-'),
-                                  LiveCount=0, IsBig=(row[2] is None))
-            child.HasChilds = check_location_childs(child, db_session)
-            if child.IsBig is False:
-                child.Ratio = calculate_par(child)
-            loc.Childs.append(child)
-        haschilds = True
-    else:
-        loc.Childs = []
-        haschilds = False
-    return haschilds
+    # (Parent OSMId, Child OSMId, Child name, Child place tag, Parent area, Child area)
+    divisions = {}
+    pairs = []
+    areas = {}
+    for parent_id, child_id, name, place, parent_area, child_area in cursor.fetchall():
+        divisions[child_id] = (name, place)
+        pairs.append((parent_id, child_id))
+        areas[parent_id] = parent_area
+        areas[child_id] = child_area
+    return divisions, pairs, areas
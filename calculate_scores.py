@@ -1,92 +1,435 @@
 """Required functions to find the stays longer than the threshold"""
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.orm.session import Session
 
-from model import ScoreLog
+from checkpoints import get_checkpoint, set_checkpoint
+from profiling import profiler
+from home_locations import get_home_join
 
 # The number of hours that count as a stay, stays less than this will be ignored
 THRESHOLD_MINUTES = 60
 # The report collection rate (how often are reports generated)
 REPORT_MINUTES = 15
 # The number of consecutive reports needed to be considered a stay
-CONSECUTIVE_COUNT = (THRESHOLD_MINUTES / REPORT_MINUTES) - 1
-# TODO: Add the functionailty to change consecutive count in the query based on this constant
+CONSECUTIVE_COUNT = THRESHOLD_MINUTES // REPORT_MINUTES - 1
+# The longest gap between two consecutive reports of a stay, in report intervals
+# (a longer gap, eg. because of missing or late reports, splits the reports into two runs)
+GAP_TOLERANCE = 1.5
+MAX_GAP_SECONDS = int(REPORT_MINUTES * 60 * GAP_TOLERANCE)
 
-def calculate(session: Session) -> None:
-    """Find the stays"""
-    query = (
-        "SELECT results.NeighbourhoodId, "
+# The power the number of stay reports after the first ones are raised to,
+# to decrease the weight of the longer stays
+STAY_EXPONENT = 0.25
+
+# The number of each user's reports before the high-water mark that are needed to classify
+# the reports around it (the old part of a run is counted if it is shorter than a stay)
+CONTEXT_REPORTS = CONSECUTIVE_COUNT
+
+# The checkpoint storing the last processed report id (the high-water mark)
+CHECKPOINT_NAME = "scores"
+
+# The number of rows fetched at once from the server-side cursor of the stream engine
+STREAM_BATCH_SIZE = 10000
+
+# The available engines to find the stays
+ENGINES = ("sql", "stream", "numpy", "async")
+
+# Store the scores of each neighbourhood for a date, replacing the stored ones,
+# formatted with the table name
+SCORE_REPLACE_UPDATE = "{table}.Score = VALUES(Score)"
+# Add the stay counts of a run to the stored ones, formatted with the table name
+# (the stay value isn't linear, so the scores are recalculated from the summed counts of all the
+# runs of the day rather than adding the values of each run)
+COUNT_ADD_UPDATE = "{table}.Count = {table}.Count + VALUES(Count)"
+
+# The statements clearing the day's stay counts before a full run, and adding the stay counts
+# of a run to them
+STAY_COUNTS_DELETE = "DELETE FROM CovidAlerter.StayCounts WHERE Date = :date"
+STAY_COUNTS_INSERT = (
+    "INSERT INTO CovidAlerter.StayCounts (Date, UserId, NeighbourhoodId, Count) "
+    "VALUES (:date, :user_id, :neighbourhood_id, :count) "
+    f"ON DUPLICATE KEY UPDATE {COUNT_ADD_UPDATE.format(table='StayCounts')}"
+)
+
+# The time buckets the stays are also scored in by the stream engine (see BucketStayDetector):
+# each hour of the day, the day and the night, and the rolling days ending on each date
+BUCKETS = ("hour", "day_night", "rolling")
+# The bucket of the whole date of the reports, which the rolling bucket sums
+DAILY_BUCKET = "daily"
+# The hours (of the report timestamps) the day and the night start at
+DAY_START_HOUR = 6
+NIGHT_START_HOUR = 20
+# The number of days summed by the rolling bucket
+ROLLING_DAYS = 7
+
+def calculate(session: Session, full: bool = False, engine: str = "sql",
+              buckets: bool = False) -> None:
+    """Find the stays in the reports sent after the last run (or in all the reports if full),
+    and optionally score them in the time buckets too (in the same scan, stream engine only)"""
+    if buckets and engine != "stream":
+        raise ValueError("The time buckets are only calculated by the stream engine")
+    if engine == "sql":
+        # INSERT ... SELECT takes shared next-key locks on the reports it reads under REPEATABLE
+        # READ, which would block the new reports until the run commits (the reports are
+        # bounded by last_id anyway)
+        session.connection(execution_options={"isolation_level": "READ COMMITTED"})
+
+    # Only process the reports up to the newest report at the start of the run
+    mark = 0 if full else int(get_checkpoint(session, CHECKPOINT_NAME, 0))
+    last_id = session.execute("SELECT MAX(Id) FROM CovidAlerter.Reports").scalar() or 0
+    if last_id <= mark:
+        return
+
+    # The stay reports of each user in each neighbourhood are added to the day's counts
+    # (a full run replaces them), then the day's scores are recalculated from all the counts
+    params = {"mark": mark, "last_id": last_id, "date": datetime.utcnow().date()}
+
+    if engine == "async":
+        # Stream the reports through the state machine while the next ones are fetched,
+        # the pipeline commits the counts and the scores along with the checkpoint on its own
+        # connection (only import the async drivers when they are used)
+        import async_pipeline
+        with profiler.stage("scores.async"):
+            async_pipeline.run_score_pipeline(mark, last_id, params["date"])
+        session.commit()
+        return
+
+    if mark == 0:
+        session.execute(STAY_COUNTS_DELETE, params)
+
+    if engine == "sql":
+        # Count the stay reports without leaving the database
+        with profiler.stage("scores.window"):
+            session.execute(
+                "INSERT INTO CovidAlerter.StayCounts (Date, UserId, NeighbourhoodId, Count) "
+                "SELECT :date, counts.UserId, counts.NeighbourhoodId, counts.StayCount "
+                f"FROM ({get_stay_counts_query(mark)}) AS counts "
+                f"ON DUPLICATE KEY UPDATE {COUNT_ADD_UPDATE.format(table='StayCounts')}",
+                params
+            )
+    else:
+        with profiler.stage(f"scores.{engine}"):
+            if engine == "stream":
+                detector = BucketStayDetector() if buckets else StayDetector()
+                counts = stream_stay_counts(session, mark, last_id, detector)
+            else:
+                # Only import NumPy when it is used
+                import vectorized_scores
+                counts = vectorized_scores.calculate(session, mark, last_id)
+        # Result row format:
+        # (UserId, NeighbourhoodId, Count)
+
+        # Store all the counts with a single executemany
+        if len(counts) > 0:
+            with profiler.stage("scores.write"):
+                session.execute(
+                    STAY_COUNTS_INSERT,
+                    [{"user_id": count[0], "neighbourhood_id": count[1], "count": count[2],
+                      "date": params["date"]} for count in counts]
+                )
+
+        # Store the counts of the time buckets found in the same scan and score them
+        if buckets:
+            with profiler.stage("scores.buckets"):
+                write_buckets(session, detector.bucket_counts, mark == 0)
+
+    # Recalculate the day's scores from its counts
+    with profiler.stage("scores.day"):
+        session.execute(get_day_scores_query(), params)
+
+    # Move the high-water mark and commit to table
+    set_checkpoint(session, CHECKPOINT_NAME, last_id)
+    with profiler.stage("scores.commit"):
+        session.commit()
+
+def get_reports_source(mark: int) -> str:
+    """Get the query selecting the reports up to :last_id that are needed to find the stays
+    after the specified high-water mark (Id, UserId, NeighbourhoodId, Timestamp, IsNew)"""
+    if mark == 0:
+        # All the reports are new
+        return (
+            "SELECT Id, UserId, NeighbourhoodId, Timestamp, TRUE AS IsNew "
+            "FROM CovidAlerter.Reports "
+            "WHERE Id <= :last_id"
+        )
+    return (
+        # The reports sent after the last run
+        "SELECT Id, UserId, NeighbourhoodId, Timestamp, TRUE AS IsNew "
+        "FROM CovidAlerter.Reports "
+        "WHERE Id > :mark AND Id <= :last_id "
+        "UNION ALL "
+        # And the last few reports of their users before the last run
+        "SELECT context.* "
+        "FROM ("
+            "SELECT DISTINCT UserId FROM CovidAlerter.Reports "
+            "WHERE Id > :mark AND Id <= :last_id"
+        ") AS active_users, "
+        "LATERAL ("
+            "SELECT Id, UserId, NeighbourhoodId, Timestamp, FALSE AS IsNew "
+            "FROM CovidAlerter.Reports AS report "
+            "WHERE report.UserId = active_users.UserId AND report.Id <= :mark "
+            f"ORDER BY report.Timestamp DESC LIMIT {CONTEXT_REPORTS}"
+        ") AS context"
+    )
+
+def get_stay_counts_query(mark: int, consecutive_count: int = CONSECUTIVE_COUNT,
+                          max_gap_seconds: int = MAX_GAP_SECONDS) -> str:
+    """Get the query finding the stays and counting the stay reports of each user in each
+    neighbourhood using MySQL window functions in a single gaps-and-islands pass
+    (UserId, NeighbourhoodId, StayCount)"""
+    return (
+        # Select the user and neighbourhood, and the number of their stay reports
+        "SELECT stays.UserId, stays.NeighbourhoodId, SUM(stays.StayCount) AS StayCount "
+        "FROM ("
+            # Count the reports of each run (island) which is a stay,
+            # the old reports were already counted on the last run if they were a stay
+            # by themselves
+            "SELECT islands.UserId, islands.NeighbourhoodId, "
+                "SUM(islands.IsNew) + "
+                f"IF(SUM(NOT islands.IsNew) < {consecutive_count}, "
+                    "SUM(NOT islands.IsNew), 0) AS StayCount "
+            "FROM ("
+                # Number the runs of each user
+                "SELECT UserId, NeighbourhoodId, IsNew, "
+                    "SUM(IsBreak) OVER (PARTITION BY UserId ORDER BY Timestamp, Id) "
+                        "AS Island "
+                "FROM ("
+                    # A run starts when the neighbourhood changes or after a long gap
+                    "SELECT Id, UserId, NeighbourhoodId, Timestamp, IsNew, "
+                        "NOT COALESCE("
+                            "LAG(NeighbourhoodId) OVER user_window <=> NeighbourhoodId "
+                            "AND "
+                            "TIMESTAMPDIFF(SECOND, LAG(Timestamp) OVER user_window, "
+                                f"Timestamp) <= {max_gap_seconds}"
+                        ", FALSE) AS IsBreak "
+                    f"FROM ({get_reports_source(mark)}) AS new_reports "
+                    "WINDOW user_window AS (PARTITION BY UserId ORDER BY Timestamp, Id)"
+                ") AS breaks"
+            ") AS islands "
+            "WHERE islands.NeighbourhoodId IS NOT NULL "
+            "GROUP BY islands.UserId, islands.Island, islands.NeighbourhoodId "
+            f"HAVING COUNT(*) >= {consecutive_count}"
+        ") AS stays "
+        # Skip the stays at the users' homes
+        + get_home_join("stays") +
+        "WHERE home.UserId IS NULL "
+        "GROUP BY stays.UserId, stays.NeighbourhoodId "
+        "HAVING SUM(stays.StayCount) > 0"
+    )
+
+def get_day_scores_query() -> str:
+    """Get the statement calculating the scores of the :date from all its stay counts,
+    replacing the stored ones"""
+    return (
+        "INSERT INTO CovidAlerter.ScoreLogs (NeighbourhoodId, Score, Date) "
+        "SELECT counts.NeighbourhoodId, "
         # Round to 2 decimal points
         "ROUND ( "
-            # The number of stays multipled by the neighbourhood ratio
-            "SUM(results.ReportCount) * neighbourhood.Ratio"
-        ", 2) "
-        "AS Score "
-        "FROM ( "
-            # Select the neighbourhood,
-            "SELECT DISTINCT windowed_reports.NeighbourhoodId, "
-            # And the number of stay reports
-            "ROUND("
-                "POWER("
-                    "COUNT(*) OVER (PARTITION BY UserId, NeighbourhoodId"
-                ") - 3, 0.25"
-            ") + 1, 2) AS ReportCount "
-            "FROM ("
-            # Run a window function to get the required columns,
-            # next timestamp, and previous timestamp of a report neighbouhoods
-            "SELECT "
-                "Id, UserId, NeighbourhoodId, Timestamp, "
-                "LEAD(NeighbourhoodId) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS next_neighbourhood,"
-                "LEAD(NeighbourhoodId, 2) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS second_next_neighbourhood, "
-                "LAG(NeighbourhoodId) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS prev_neighbourhood, "
-                "LAG(NeighbourhoodId, 2) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS second_prev_neighbourhood, "
-                "LEAD(Timestamp) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS next_timestamp, "
-                "LAG(Timestamp) OVER (PARTITION BY UserId ORDER BY Timestamp) "
-                    "AS prev_timestamp "
-            "FROM CovidAlerter.Reports"
-            ") AS windowed_reports "
-            "WHERE "
-                # The report is the start of a stay
-                "("
-                    "windowed_reports.NeighbourhoodId = windowed_reports.next_neighbourhood "
-                    "AND "
-                    "windowed_reports.NeighbourhoodId = windowed_reports.second_next_neighbourhood"
-                ") "
-                "OR "
-                # The report is in the middle of a stay
-                "("
-                    "windowed_reports.NeighbourhoodId = windowed_reports.next_neighbourhood "
-                    "AND "
-                    "windowed_reports.NeighbourhoodId = windowed_reports.prev_neighbourhood"
-                ") "
-                "OR "
-                # The report is the end of a stay
-                "("
-                    "windowed_reports.NeighbourhoodId = windowed_reports.prev_neighbourhood "
-                    "AND "
-                    "windowed_reports.NeighbourhoodId = windowed_reports.second_prev_neighbourhood"
-                ") "
-        ") AS results "
+            # The value of the stays multipled by the neighbourhood ratio
+            f"SUM({get_stay_value_expression('counts.Count')}) * neighbourhood.Ratio"
+        ", 2), :date "
+        "FROM CovidAlerter.StayCounts AS counts "
         # Join the neighbourhood to get the ratio
         "INNER JOIN CovidAlerter.Neighbourhoods AS neighbourhood "
-        "ON results.NeighbourhoodId = neighbourhood.Id "
-        "GROUP BY results.NeighbourhoodId"
-        ";"
+        "ON counts.NeighbourhoodId = neighbourhood.Id "
+        "WHERE counts.Date = :date "
+        "GROUP BY counts.NeighbourhoodId "
+        f"ON DUPLICATE KEY UPDATE {SCORE_REPLACE_UPDATE.format(table='ScoreLogs')}"
     )
-    results = session.execute(query).fetchall()
-    # Result row format:
-    # (NeighbourhoodId, Score)
-
-    # Create a table row for each neighbourhood
-    # TODO: Remove this in favor of a solution inside the original SQL query
-    logs = [ScoreLog(NeighbourhoodId=result[0], Score=result[1],
-                    Date=datetime.utcnow().date()) for result in results]
-
-    # Add the scores and commit to table
-    session.add_all(logs)
-    session.commit()
+
+def get_stay_value_expression(count: str, consecutive_count: int = CONSECUTIVE_COUNT) -> str:
+    """Get the expression of the value of a user's stay reports count in a neighbourhood
+    (or a bucket of it)"""
+    # Add 1 point for the first reports, and decrease the weight of the rest
+    return f"ROUND(POWER(GREATEST({count} - {consecutive_count}, 0), {STAY_EXPONENT}) + 1, 2)"
+
+def stream_stay_counts(session: Session, mark: int, last_id: int,
+                       detector: "StayDetector" = None) -> list:
+    """Find the stays and count the stay reports of each user in each neighbourhood by streaming
+    the reports through a state machine, without any window functions on the database server
+    ([(UserId, NeighbourhoodId, Count)])"""
+    # Stream the reports with a server-side cursor
+    connection = session.connection().execution_options(stream_results=True)
+    rows = connection.execute(get_stream_query(mark), {"mark": mark, "last_id": last_id})
+    detector = detector or StayDetector()
+    while True:
+        batch = rows.fetchmany(STREAM_BATCH_SIZE)
+        if not batch:
+            break
+        for row in batch:
+            detector.add(*row)
+    return [(user_id, neighbourhood_id, count)
+            for (user_id, neighbourhood_id), count in detector.finish().items()]
+
+def write_buckets(session: Session, bucket_counts: dict, replace: bool) -> None:
+    """Store the stay counts of the time buckets ({(UserId, NeighbourhoodId, date, bucket): count}),
+    replacing the stored counts of their dates or adding to them, and recalculate the scores of
+    the buckets of these dates and of the rolling buckets which include them"""
+    if not bucket_counts:
+        return
+    dates = [date for _, _, date, _ in bucket_counts]
+    params = {"first_date": min(dates), "last_date": max(dates)}
+    if replace:
+        session.execute(
+            "DELETE FROM CovidAlerter.BucketStayCounts "
+            "WHERE Date BETWEEN :first_date AND :last_date",
+            params
+        )
+    session.execute(
+        "INSERT INTO CovidAlerter.BucketStayCounts "
+        "(Date, Bucket, UserId, NeighbourhoodId, Count) "
+        "VALUES (:date, :bucket, :user_id, :neighbourhood_id, :count) "
+        f"ON DUPLICATE KEY UPDATE {COUNT_ADD_UPDATE.format(table='BucketStayCounts')}",
+        [{"user_id": user_id, "neighbourhood_id": neighbourhood_id, "date": date,
+          "bucket": bucket, "count": count}
+         for (user_id, neighbourhood_id, date, bucket), count in bucket_counts.items()]
+    )
+
+    # Score the buckets of the changed dates again from all their counts
+    session.execute(
+        "INSERT INTO CovidAlerter.BucketScoreLogs (NeighbourhoodId, Date, Bucket, Score) "
+        "SELECT counts.NeighbourhoodId, counts.Date, counts.Bucket, ROUND("
+            f"SUM({get_stay_value_expression('counts.Count')}) * neighbourhood.Ratio, 2) "
+        "FROM CovidAlerter.BucketStayCounts AS counts "
+        "INNER JOIN CovidAlerter.Neighbourhoods AS neighbourhood "
+        "ON counts.NeighbourhoodId = neighbourhood.Id "
+        "WHERE counts.Date BETWEEN :first_date AND :last_date "
+        "GROUP BY counts.NeighbourhoodId, counts.Date, counts.Bucket "
+        "ON DUPLICATE KEY UPDATE BucketScoreLogs.Score = VALUES(Score)",
+        params
+    )
+    if "rolling" not in BUCKETS:
+        return
+
+    # Sum the stored daily buckets again for each rolling window ending on a changed date or
+    # on one of the following days (up to today), one date at a time
+    newest = max(dates)
+    last_date = max(newest, min(newest + timedelta(days=ROLLING_DAYS - 1),
+                                datetime.utcnow().date()))
+    rolling_dates = [min(dates) + timedelta(days=day)
+                     for day in range((last_date - min(dates)).days + 1)]
+    session.execute(
+        "INSERT INTO CovidAlerter.BucketScoreLogs (NeighbourhoodId, Date, Bucket, Score) "
+        "SELECT daily.NeighbourhoodId, :date, :bucket, ROUND(SUM(daily.Score), 2) "
+        "FROM CovidAlerter.BucketScoreLogs AS daily "
+        "WHERE daily.Bucket = :daily_bucket "
+        "AND daily.Date BETWEEN CAST(:date AS DATE) - INTERVAL :days DAY AND :date "
+        "GROUP BY daily.NeighbourhoodId "
+        "ON DUPLICATE KEY UPDATE BucketScoreLogs.Score = VALUES(Score)",
+        [{"date": date, "bucket": f"rolling-{ROLLING_DAYS}d", "daily_bucket": DAILY_BUCKET,
+          "days": ROLLING_DAYS - 1} for date in rolling_dates]
+    )
+
+def get_buckets(timestamp: datetime) -> list:
+    """Get the time buckets of a report ([(date, bucket)])"""
+    date = timestamp.date()
+    buckets = [(date, DAILY_BUCKET)]
+    if "hour" in BUCKETS:
+        buckets.append((date, f"hour-{timestamp.hour:02}"))
+    if "day_night" in BUCKETS:
+        buckets.append((date, "day" if DAY_START_HOUR <= timestamp.hour < NIGHT_START_HOUR
+                        else "night"))
+    return buckets
+
+def get_stream_query(mark: int) -> str:
+    """Get the query selecting the reports needed by the state machine in order
+    (UserId, NeighbourhoodId, IsNew, Timestamp, IsHome)"""
+    return (
+        "SELECT reports.UserId, reports.NeighbourhoodId, reports.IsNew, reports.Timestamp, "
+            "home.UserId IS NOT NULL AS IsHome "
+        f"FROM ({get_reports_source(mark)}) AS reports "
+        # Mark the reports sent from the users' homes
+        + get_home_join("reports") +
+        "ORDER BY reports.UserId, reports.Timestamp, reports.Id"
+    )
+
+
+class StayDetector:
+    """Finds the stays in reports ordered by (UserId, Timestamp), keeping only the state of the
+    current run, and counts the stay reports of each user in each neighbourhood"""
+
+    def __init__(self):
+        # The number of stay reports of each (UserId, NeighbourhoodId)
+        self.counts = {}
+        # The current user
+        self.user_id = None
+        # The current run of reports in the same neighbourhood, and the time of its last report
+        self.neighbourhood_id = None
+        self.old_length = 0
+        self.new_length = 0
+        self.timestamp = None
+        # Whether the current run is at the user's home (see home_locations)
+        self.is_home = False
+
+    def add(self, user_id: int, neighbourhood_id: int, is_new: bool,
+            timestamp: datetime = None, is_home: bool = False) -> None:
+        """Add the next report"""
+        if user_id != self.user_id or neighbourhood_id != self.neighbourhood_id or (
+                timestamp is not None and self.timestamp is not None and
+                (timestamp - self.timestamp).total_seconds() > MAX_GAP_SECONDS):
+            # The run ends when the user or the neighbourhood changes or after a long gap
+            self.end_run()
+        self.user_id = user_id
+        self.neighbourhood_id = neighbourhood_id
+        self.timestamp = timestamp
+        self.is_home = is_home
+        if is_new:
+            self.new_length += 1
+        else:
+            self.old_length += 1
+
+    def end_run(self) -> None:
+        """Count the stay reports of the current run"""
+        if self.is_stay():
+            # The old reports were already counted on the last run if they were a stay by themselves
+            count = self.new_length
+            if self.old_length < CONSECUTIVE_COUNT:
+                count += self.old_length
+            # A run of old reports which were already counted has no stay reports left
+            if count > 0:
+                key = (self.user_id, self.neighbourhood_id)
+                self.counts[key] = self.counts.get(key, 0) + count
+        self.neighbourhood_id = None
+        self.old_length = 0
+        self.new_length = 0
+
+    def is_stay(self) -> bool:
+        """Whether the current run is a stay (which isn't at the user's home)"""
+        return (self.neighbourhood_id is not None and not self.is_home and
+                self.old_length + self.new_length >= CONSECUTIVE_COUNT)
+
+    def finish(self) -> dict:
+        """Finish the last run and get the counts ({(UserId, NeighbourhoodId): count})"""
+        self.end_run()
+        return self.counts
+
+
+class BucketStayDetector(StayDetector):
+    """A StayDetector which also counts the stay reports of each user in the time buckets of each
+    neighbourhood (see get_buckets), the reports must have their timestamp"""
+
+    def __init__(self):
+        super().__init__()
+        # The number of stay reports of each (UserId, NeighbourhoodId, date, bucket)
+        self.bucket_counts = {}
+        # Whether each report of the current run is new, and its buckets
+        self.run_buckets = []
+
+    def add(self, user_id: int, neighbourhood_id: int, is_new: bool,
+            timestamp: datetime = None, is_home: bool = False) -> None:
+        """Add the next report"""
+        super().add(user_id, neighbourhood_id, is_new, timestamp, is_home)
+        self.run_buckets.append((is_new, get_buckets(timestamp)))
+
+    def end_run(self) -> None:
+        """Count the stay reports of the current run in their buckets"""
+        if self.is_stay():
+            # Only count the reports which are counted in the neighbourhood counts too
+            count_old = self.old_length < CONSECUTIVE_COUNT
+            for is_new, buckets in self.run_buckets:
+                if is_new or count_old:
+                    for date, bucket in buckets:
+                        key = (self.user_id, self.neighbourhood_id, date, bucket)
+                        self.bucket_counts[key] = self.bucket_counts.get(key, 0) + 1
+        self.run_buckets = []
+        super().end_run()
@@ -0,0 +1,15 @@
+"""Required functions to store the progress of the incremental stages"""
+from sqlalchemy.orm.session import Session
+
+from model import Checkpoint
+
+
+def get_checkpoint(session: Session, name: str, default: str = None) -> str:
+    """Get the value of the specified checkpoint (default if it isn't stored yet)"""
+    checkpoint = session.query(Checkpoint).get(name)
+    return checkpoint.Value if checkpoint is not None else default
+
+
+def set_checkpoint(session: Session, name: str, value) -> None:
+    """Store the value of the specified checkpoint (committed along with the session)"""
+    session.merge(Checkpoint(Name=name, Value=str(value)))
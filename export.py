@@ -0,0 +1,90 @@
+"""Required functions to export the scores, the PAR and the hierarchy to Parquet files
+partitioned by date, for the analysts to read instead of the main database"""
+import os
+from datetime import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.orm.session import Session
+
+from checkpoints import get_checkpoint, set_checkpoint
+from profiling import profiler
+
+# The checkpoint storing the last exported date (its scores may still change on that day)
+CHECKPOINT_NAME = "export"
+
+# The number of rows fetched at once while exporting a table
+EXPORT_BATCH_SIZE = 100000
+
+# The query selecting each exported dataset and the type of each of its columns
+# (the scores are selected from the :since date, the other datasets are daily snapshots)
+DATASETS = {
+    "scores": (
+        "SELECT NeighbourhoodId, Score, DATE(Date) "
+        "FROM CovidAlerter.ScoreLogs "
+        "WHERE Date >= :since",
+        {"NeighbourhoodId": np.int64, "Score": np.float64, "Date": object},
+    ),
+    "neighbourhoods": (
+        "SELECT Id, OSMId, Name, IsBig, Area, Ratio, OutdoorArea, HouseArea, CommercialArea "
+        "FROM CovidAlerter.Neighbourhoods",
+        {"Id": np.int64, "OSMId": object, "Name": object, "IsBig": object,
+         "Area": np.float64, "Ratio": np.float64, "OutdoorArea": np.float64,
+         "HouseArea": np.float64, "CommercialArea": np.float64},
+    ),
+    "hierarchy": (
+        "SELECT ParentsId, ChildsId FROM CovidAlerter.ChildParents",
+        {"ParentsId": np.int64, "ChildsId": np.int64},
+    ),
+}
+
+
+def export(session: Session, directory: str) -> None:
+    """Export the scores of the dates since the last export and today's snapshot of the
+    neighbourhoods and the hierarchy to the directory ({dataset}/Date=YYYY-MM-DD/*.parquet)"""
+    today = datetime.utcnow().date()
+    since = get_checkpoint(session, CHECKPOINT_NAME, "1970-01-01")
+
+    for name, (query, types) in DATASETS.items():
+        with profiler.stage(f"export.{name}"):
+            columns = load_columns(session, query, types, {"since": since})
+            if name == "scores":
+                # Rewrite the partition of each exported date, the older ones are kept
+                dates = columns.pop("Date")
+                for date in sorted(set(dates)):
+                    selected = dates == date
+                    write_partition(directory, name, date,
+                                    {column: values[selected]
+                                     for column, values in columns.items()})
+            else:
+                write_partition(directory, name, today, columns)
+
+    set_checkpoint(session, CHECKPOINT_NAME, today.isoformat())
+    session.commit()
+
+def load_columns(session: Session, query: str, types: dict, params: dict) -> dict:
+    """Load the rows of a query as NumPy columns ({name: array}, NULL numbers are NaN)"""
+    rows = session.execute(query, params)
+    values = {name: [] for name in types}
+    while True:
+        batch = rows.fetchmany(EXPORT_BATCH_SIZE)
+        if not batch:
+            break
+        for index, (name, dtype) in enumerate(types.items()):
+            if dtype is np.float64:
+                values[name].extend(np.nan if row[index] is None else row[index] for row in batch)
+            else:
+                values[name].extend(row[index] for row in batch)
+    return {name: np.array(values[name], dtype=dtype) for name, dtype in types.items()}
+
+def write_partition(directory: str, dataset: str, date, columns: dict) -> None:
+    """Write the columns to the Parquet file of a date partition, replacing it atomically"""
+    # The numeric columns are wrapped without copying them, NaN marks the missing values
+    arrays = {name: pa.array(values, mask=np.isnan(values))
+              if values.dtype == np.float64 else pa.array(values)
+              for name, values in columns.items()}
+    partition = os.path.join(directory, dataset, f"Date={date.isoformat()}")
+    os.makedirs(partition, exist_ok=True)
+    path = os.path.join(partition, "part-0.parquet")
+    pq.write_table(pa.table(arrays), path + ".tmp")
+    os.replace(path + ".tmp", path)
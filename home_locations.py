@@ -0,0 +1,122 @@
+"""Required functions to maintain the index of the users' homes (the neighbourhood of most of
+their overnight reports), whose stays are not scored"""
+from datetime import datetime
+from sqlalchemy.orm.session import Session
+
+from model import HomeCandidate, UserHome
+from checkpoints import get_checkpoint, set_checkpoint
+from profiling import profiler
+
+# The hours (of the report timestamps) whose reports are overnight reports,
+# from the start hour up to (not including) the end hour
+NIGHT_START_HOUR = 22
+NIGHT_END_HOUR = 6
+
+# The daily decay of the overnight reports weight, so that the home of a user who moves changes
+HOME_DAILY_DECAY = 0.97
+
+# The number of candidate neighbourhoods kept for each user, which bounds the index size
+HOME_CANDIDATES = 3
+
+# The weight (about 2 nights of reports) and the share of the user's candidates weight that
+# the top candidate needs to be the user's home
+MIN_HOME_WEIGHT = 50
+MIN_HOME_SHARE = 0.5
+
+# The checkpoint storing the last report added to the index
+CHECKPOINT_NAME = "homes"
+
+# The number of users whose candidates are merged and stored at once
+USER_BATCH_SIZE = 5000
+
+
+def update(session: Session, rebuild: bool = False) -> None:
+    """Add the overnight reports sent after the last update to the index
+    (or rebuild the index from all the reports)"""
+    mark = 0 if rebuild else int(get_checkpoint(session, CHECKPOINT_NAME, 0))
+    last_id = session.execute("SELECT MAX(Id) FROM CovidAlerter.Reports").scalar() or 0
+    if last_id <= mark:
+        return
+    today = datetime.utcnow().date()
+
+    if rebuild:
+        with profiler.stage("homes.clear"):
+            session.query(UserHome).delete()
+            session.query(HomeCandidate).delete()
+
+    # Weight the new overnight reports of each user in each neighbourhood, decayed to today
+    with profiler.stage("homes.reports"):
+        rows = session.execute(
+            "SELECT UserId, NeighbourhoodId, "
+                "SUM(POW(:decay, GREATEST(DATEDIFF(:today, Timestamp), 0))) "
+            "FROM CovidAlerter.Reports "
+            "WHERE Id > :mark AND Id <= :last_id AND NeighbourhoodId IS NOT NULL "
+            "AND (HOUR(Timestamp) >= :night_start OR HOUR(Timestamp) < :night_end) "
+            "GROUP BY UserId, NeighbourhoodId",
+            {"decay": HOME_DAILY_DECAY, "today": today, "mark": mark, "last_id": last_id,
+             "night_start": NIGHT_START_HOUR, "night_end": NIGHT_END_HOUR}
+        ).fetchall()
+    # Result row format:
+    # (UserId, NeighbourhoodId, Weight)
+    weights = {}
+    for user_id, neighbourhood_id, weight in rows:
+        weights.setdefault(user_id, {})[neighbourhood_id] = float(weight)
+
+    # Merge them with the stored candidates of the same users
+    with profiler.stage("homes.merge"):
+        user_ids = list(weights)
+        for index in range(0, len(user_ids), USER_BATCH_SIZE):
+            batch = {user_id: weights[user_id]
+                     for user_id in user_ids[index:index + USER_BATCH_SIZE]}
+            merge_candidates(session, batch, today, rebuild)
+
+    # Move the high-water mark and commit to table
+    set_checkpoint(session, CHECKPOINT_NAME, last_id)
+    with profiler.stage("homes.commit"):
+        session.commit()
+
+def merge_candidates(session: Session, weights: dict, today, rebuild: bool = False) -> None:
+    """Add the new weights ({UserId: {NeighbourhoodId: weight}}) to the stored candidates of the
+    users, keeping the top HOME_CANDIDATES of each user, and store their homes"""
+    user_ids = list(weights)
+    if not rebuild:
+        # Decay the stored weights to today
+        for candidate in session.query(HomeCandidate).filter(
+                HomeCandidate.UserId.in_(user_ids)):
+            days = max((today - candidate.UpdatedAt.date()).days, 0)
+            user_weights = weights[candidate.UserId]
+            user_weights[candidate.NeighbourhoodId] = (
+                user_weights.get(candidate.NeighbourhoodId, 0) +
+                candidate.Weight * HOME_DAILY_DECAY ** days
+            )
+        session.query(HomeCandidate).filter(HomeCandidate.UserId.in_(user_ids)).delete(
+            synchronize_session=False)
+        session.query(UserHome).filter(UserHome.UserId.in_(user_ids)).delete(
+            synchronize_session=False)
+
+    candidates = []
+    homes = []
+    for user_id, user_weights in weights.items():
+        top = sorted(user_weights.items(), key=lambda item: item[1],
+                     reverse=True)[:HOME_CANDIDATES]
+        candidates.extend({"UserId": user_id, "NeighbourhoodId": neighbourhood_id,
+                           "Weight": weight, "UpdatedAt": today}
+                          for neighbourhood_id, weight in top)
+
+        # The home is the neighbourhood of most of the user's overnight reports
+        home_id, home_weight = top[0]
+        if (home_weight >= MIN_HOME_WEIGHT and
+                home_weight >= MIN_HOME_SHARE * sum(weight for _, weight in top)):
+            homes.append({"UserId": user_id, "NeighbourhoodId": home_id})
+
+    # Store all the candidates and homes of the users with bulk statements
+    session.bulk_insert_mappings(HomeCandidate, candidates)
+    session.bulk_insert_mappings(UserHome, homes)
+
+def get_home_join(alias: str) -> str:
+    """Get the join matching the rows of the aliased query (with UserId and NeighbourhoodId)
+    with the users' homes (aliased as home, home.UserId is NULL if it isn't the user's home)"""
+    return (
+        "LEFT JOIN CovidAlerter.UserHomes AS home "
+        f"ON home.UserId = {alias}.UserId AND home.NeighbourhoodId = {alias}.NeighbourhoodId "
+    )
@@ -0,0 +1,162 @@
+"""Required functions to keep the live count of each neighbourhood up to date from the new
+reports, in micro-batches"""
+from datetime import datetime, timedelta
+from sqlalchemy.orm.session import Session
+
+from checkpoints import get_checkpoint, set_checkpoint
+from profiling import profiler
+
+# The number of report ids processed in a single transaction
+LIVE_BATCH_SIZE = 10000
+
+# The minutes after their last interaction the users are not counted as live anymore
+LIVE_EXPIRY_MINUTES = 30
+
+# The checkpoints storing the last processed report id and the last expiry time
+CHECKPOINT_NAME = "live"
+EXPIRY_CHECKPOINT_NAME = "live.expiry"
+
+# The first expiry sweep expires all the users inactive since before it
+FIRST_EXPIRY = datetime(1970, 1, 1)
+
+
+def update(session: Session, full: bool = False) -> None:
+    """Move the users to the neighbourhood of their last new report and expire the inactive
+    users, updating the live counts with delta statements (or recount them all if full)"""
+    # The users whose last interaction is before the expiry time are not live anymore
+    expiry = datetime.utcnow() - timedelta(minutes=LIVE_EXPIRY_MINUTES)
+    if full:
+        with profiler.stage("live.recount"):
+            recount(session, expiry)
+
+    # Only process the reports up to the newest report at the start of the run, the first run
+    # and a recount start from it rather than replaying the whole history of the reports
+    last_id = session.execute("SELECT MAX(Id) FROM CovidAlerter.Reports").scalar() or 0
+    mark = get_checkpoint(session, CHECKPOINT_NAME)
+    if full or mark is None:
+        mark = last_id
+        set_checkpoint(session, CHECKPOINT_NAME, last_id)
+    mark = int(mark)
+    for first_id in range(mark, last_id, LIVE_BATCH_SIZE):
+        params = {"first_id": first_id, "last_id": min(first_id + LIVE_BATCH_SIZE, last_id),
+                  "expiry": expiry}
+        with profiler.stage("live.moves"):
+            move_users(session, params)
+        set_checkpoint(session, CHECKPOINT_NAME, params["last_id"])
+        with profiler.stage("live.commit"):
+            session.commit()
+
+    # Expire the users whose last interaction is between the last sweep and the expiry time
+    since = get_checkpoint(session, EXPIRY_CHECKPOINT_NAME)
+    params = {
+        "since": datetime.fromisoformat(since) if since is not None else FIRST_EXPIRY,
+        "until": expiry,
+    }
+    with profiler.stage("live.expiry"):
+        expire_users(session, params)
+    set_checkpoint(session, EXPIRY_CHECKPOINT_NAME, params["until"].isoformat())
+    with profiler.stage("live.commit"):
+        session.commit()
+
+def get_latest_reports_query() -> str:
+    """Get the query selecting the last report of each user with an id in the
+    (:first_id, :last_id] range (UserId, NeighbourhoodId)"""
+    return (
+        "SELECT ordered.UserId, ordered.NeighbourhoodId "
+        "FROM ("
+            "SELECT UserId, NeighbourhoodId, "
+                "ROW_NUMBER() OVER (PARTITION BY UserId ORDER BY Timestamp DESC, Id DESC) "
+                    "AS position "
+            "FROM CovidAlerter.Reports "
+            "WHERE Id > :first_id AND Id <= :last_id"
+        ") AS ordered "
+        "WHERE ordered.position = 1"
+    )
+
+def move_users(session: Session, params: dict) -> None:
+    """Apply the moves of the users in a micro-batch of reports to the live counts and the
+    users' last locations, skipping the users inactive since before the :expiry time (the expiry
+    sweeps after it would never remove them, eg. when catching up on old reports)"""
+    # Add the delta of all the moves to each of the neighbourhoods in one statement
+    session.execute(
+        "WITH moves AS ("
+            # The users whose last report is in another neighbourhood
+            "SELECT users.LastLocationId AS OldId, latest.NeighbourhoodId AS NewId "
+            f"FROM ({get_latest_reports_query()}) AS latest "
+            "INNER JOIN CovidAlerter.Users AS users ON users.Id = latest.UserId "
+            "WHERE NOT (users.LastLocationId <=> latest.NeighbourhoodId) "
+            "AND users.LastInteraction >= :expiry"
+        ") "
+        "UPDATE CovidAlerter.Neighbourhoods AS neighbourhood "
+        "INNER JOIN ("
+            "SELECT changes.NeighbourhoodId, SUM(changes.Delta) AS Delta "
+            "FROM ("
+                "SELECT NewId AS NeighbourhoodId, 1 AS Delta FROM moves WHERE NewId IS NOT NULL "
+                "UNION ALL "
+                "SELECT OldId, -1 FROM moves WHERE OldId IS NOT NULL"
+            ") AS changes "
+            "GROUP BY changes.NeighbourhoodId"
+        ") AS deltas "
+        "ON deltas.NeighbourhoodId = neighbourhood.Id "
+        "SET neighbourhood.LiveCount = "
+            "GREATEST(COALESCE(neighbourhood.LiveCount, 0) + deltas.Delta, 0)",
+        params
+    )
+
+    # Move the users
+    session.execute(
+        "UPDATE CovidAlerter.Users AS users "
+        f"INNER JOIN ({get_latest_reports_query()}) AS latest "
+        "ON users.Id = latest.UserId "
+        "SET users.LastLocationId = latest.NeighbourhoodId "
+        "WHERE users.LastInteraction >= :expiry",
+        params
+    )
+
+def expire_users(session: Session, params: dict) -> None:
+    """Remove the users whose last interaction is in the [:since, :until) range from the live
+    counts (found through the LastInteraction index)"""
+    expired_filter = (
+        "LastInteraction >= :since AND LastInteraction < :until "
+        "AND LastLocationId IS NOT NULL"
+    )
+    session.execute(
+        "UPDATE CovidAlerter.Neighbourhoods AS neighbourhood "
+        "INNER JOIN ("
+            "SELECT LastLocationId, COUNT(*) AS Count "
+            "FROM CovidAlerter.Users "
+            f"WHERE {expired_filter} "
+            "GROUP BY LastLocationId"
+        ") AS expired "
+        "ON expired.LastLocationId = neighbourhood.Id "
+        "SET neighbourhood.LiveCount = "
+            "GREATEST(COALESCE(neighbourhood.LiveCount, 0) - expired.Count, 0)",
+        params
+    )
+    session.execute(
+        "UPDATE CovidAlerter.Users SET LastLocationId = NULL "
+        f"WHERE {expired_filter}",
+        params
+    )
+
+def recount(session: Session, expiry: datetime) -> None:
+    """Recount the live users of all the neighbourhoods from the last locations of the users
+    active since the expiry time, removing the other ones (a full scan of the users, only needed
+    to repair the counts)"""
+    session.execute(
+        "UPDATE CovidAlerter.Users SET LastLocationId = NULL "
+        "WHERE LastLocationId IS NOT NULL "
+        "AND (LastInteraction IS NULL OR LastInteraction < :expiry)",
+        {"expiry": expiry}
+    )
+    session.execute(
+        "UPDATE CovidAlerter.Neighbourhoods AS neighbourhood "
+        "LEFT JOIN ("
+            "SELECT LastLocationId, COUNT(*) AS Count "
+            "FROM CovidAlerter.Users "
+            "WHERE LastLocationId IS NOT NULL "
+            "GROUP BY LastLocationId"
+        ") AS live "
+        "ON live.LastLocationId = neighbourhood.Id "
+        "SET neighbourhood.LiveCount = COALESCE(live.Count, 0)"
+    )
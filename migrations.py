@@ -0,0 +1,145 @@
+"""Required functions to migrate an existing database to the current model
+(create_all only creates the missing tables), and to partition the reports"""
+from datetime import date, datetime
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.schema import UniqueConstraint
+from sqlalchemy.sql.sqltypes import String
+
+from model import Base
+
+# The number of months partitioned ahead of the current one
+PARTITION_MONTHS_AHEAD = 2
+
+# The prefix of the tables the archived report partitions are moved to
+ARCHIVE_TABLE_PREFIX = "ReportsArchive_"
+
+
+def migrate(engine: Engine) -> None:
+    """Add the columns, the indexes and the unique keys of the model which are missing from the
+    existing tables, and resize the indexed string columns which have a length in the model"""
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"]: column for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                definition = CreateColumn(column).compile(dialect=engine.dialect)
+                if column.name not in existing:
+                    connection.execute(f"ALTER TABLE {table.name} ADD COLUMN {definition}")
+                elif (column.index and isinstance(column.type, String) and
+                      column.type.length is not None and
+                      getattr(existing[column.name]["type"], "length", None) != column.type.length):
+                    # The columns need a length to be indexed (eg. OSMId used to be a TEXT),
+                    # the other ones are left as they are so their values aren't truncated
+                    connection.execute(f"ALTER TABLE {table.name} MODIFY COLUMN {definition}")
+
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+
+            existing_uniques = {tuple(constraint["column_names"]) for constraint in
+                                inspector.get_unique_constraints(table.name)}
+            for constraint in table.constraints:
+                columns = tuple(column.name for column in constraint.columns)
+                if isinstance(constraint, UniqueConstraint) and columns not in existing_uniques:
+                    if "Id" in table.columns:
+                        # Keep the latest row of each key (eg. a score log was added on every
+                        # run of the day before the scores were upserted)
+                        connection.execute(
+                            f"DELETE older FROM {table.name} AS older "
+                            f"INNER JOIN {table.name} AS newer "
+                            "ON " + " AND ".join(f"newer.{column} = older.{column}"
+                                                 for column in columns) +
+                            " AND newer.Id > older.Id"
+                        )
+                    connection.execute(
+                        f"ALTER TABLE {table.name} ADD UNIQUE ({', '.join(columns)})")
+
+
+def partition_reports(engine: Engine) -> None:
+    """Partition the reports by the month of their timestamp (or add the partitions of the next
+    months if they are already partitioned), so that old months can be archived
+    (MySQL needs Timestamp in the primary key and doesn't support foreign keys on partitioned
+    tables, so they are dropped)"""
+    today = datetime.utcnow().date()
+    with engine.begin() as connection:
+        partitions = get_report_partitions(connection)
+        if not partitions:
+            first = connection.execute("SELECT MIN(Timestamp) FROM Reports").scalar() or today
+            for foreign_key in sqlalchemy.inspect(connection).get_foreign_keys("Reports"):
+                connection.execute(f"ALTER TABLE Reports DROP FOREIGN KEY {foreign_key['name']}")
+            connection.execute(
+                "ALTER TABLE Reports MODIFY Timestamp DATETIME NOT NULL, "
+                "DROP PRIMARY KEY, ADD PRIMARY KEY (Id, Timestamp)"
+            )
+            months = get_months(date(first.year, first.month, 1), today)
+            connection.execute(
+                "ALTER TABLE Reports PARTITION BY RANGE (TO_DAYS(Timestamp)) ("
+                + "".join(get_partition_definition(month) + ", " for month in months) +
+                "PARTITION future VALUES LESS THAN MAXVALUE)"
+            )
+            return
+
+        # Split the next months from the last partition
+        last = max(name for name in partitions if name != "future")
+        months = [month for month in get_months(today, today)
+                  if get_partition_name(month) > last]
+        if months:
+            connection.execute(
+                "ALTER TABLE Reports REORGANIZE PARTITION future INTO ("
+                + "".join(get_partition_definition(month) + ", " for month in months) +
+                "PARTITION future VALUES LESS THAN MAXVALUE)"
+            )
+
+
+def archive_report_partitions(engine: Engine, before: date) -> list:
+    """Move the report partitions of the months before the specified date to their own
+    tables (ReportsArchive_pYYYYMM, to be dumped or dropped) and get their names"""
+    archived = []
+    with engine.begin() as connection:
+        for name in get_report_partitions(connection):
+            if name == "future" or name >= get_partition_name(before):
+                continue
+            table = ARCHIVE_TABLE_PREFIX + name
+            connection.execute(f"CREATE TABLE {table} LIKE Reports")
+            connection.execute(f"ALTER TABLE {table} REMOVE PARTITIONING")
+            connection.execute(f"ALTER TABLE Reports EXCHANGE PARTITION {name} WITH TABLE {table}")
+            connection.execute(f"ALTER TABLE Reports DROP PARTITION {name}")
+            archived.append(table)
+    return archived
+
+
+def get_report_partitions(connection) -> list:
+    """Get the names of the report partitions in order (empty if they aren't partitioned)"""
+    return [name for name, in connection.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Reports' "
+        "AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    )]
+
+
+def get_months(first: date, today: date) -> list:
+    """Get the first day of each month from the first date's month to PARTITION_MONTHS_AHEAD
+    months after today's month"""
+    months = []
+    year, month = first.year, first.month
+    last = today.year * 12 + today.month - 1 + PARTITION_MONTHS_AHEAD
+    while year * 12 + month - 1 <= last:
+        months.append(date(year, month, 1))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def get_partition_name(month: date) -> str:
+    """Get the name of the partition of a month (pYYYYMM)"""
+    return f"p{month.year:04}{month.month:02}"
+
+
+def get_partition_definition(month: date) -> str:
+    """Get the definition of the partition of a month"""
+    end = date(month.year + 1, 1, 1) if month.month == 12 else date(month.year, month.month + 1, 1)
+    return (f"PARTITION {get_partition_name(month)} "
+            f"VALUES LESS THAN (TO_DAYS('{end.isoformat()}'))")
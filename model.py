@@ -1,6 +1,6 @@
 """The database model"""
-from sqlalchemy.sql.schema import ForeignKey
-from sqlalchemy.sql.sqltypes import Boolean, DateTime, Integer, String, Numeric, Float
+from sqlalchemy.sql.schema import ForeignKey, Index, UniqueConstraint
+from sqlalchemy.sql.sqltypes import Boolean, DateTime, Integer, String, Numeric, Float, Text
 import sqlalchemy
 import sqlalchemy.orm
 from sqlalchemy.orm import relationship
@@ -11,6 +11,11 @@ Base = declarative_base()
 class Report(Base):
     """The reports table model"""
     __tablename__ = "Reports"
+    # The stays are found in the reports of each user ordered by time
+    __table_args__ = (
+        Index("ix_Reports_UserId_Timestamp_NeighbourhoodId",
+              "UserId", "Timestamp", "NeighbourhoodId"),
+    )
     Id = sqlalchemy.Column(Integer, primary_key=True)
     Longitude = sqlalchemy.Column(Numeric)
     Latitude = sqlalchemy.Column(Numeric)
@@ -34,15 +39,15 @@ class User(Base):
     Id = sqlalchemy.Column(Integer, primary_key=True)
 
     # The user settings
-    Settings = sqlalchemy.Column(String)
+    Settings = sqlalchemy.Column(Text)
 
-    # The user last interaction time (used to expire the tokens)
-    LastInteraction = sqlalchemy.Column(DateTime)
+    # The user last interaction time (used to expire the tokens, and the live counts)
+    LastInteraction = sqlalchemy.Column(DateTime, index=True)
 
     # The user's Google Account Id
-    GoogleId = sqlalchemy.Column(String)
+    GoogleId = sqlalchemy.Column(String(255))
 
-    SessionId = sqlalchemy.Column(String)
+    SessionId = sqlalchemy.Column(String(255))
 
     # The user's last neighbourhood (used for live count)
     LastLocationId = sqlalchemy.Column(
@@ -66,8 +71,11 @@ class Neighbourhood(Base):
     __tablename__ = "Neighbourhoods"
     Id = sqlalchemy.Column(Integer, primary_key=True, autoincrement=True)
 
-    # The neighbourhood PAR
+    # The neighbourhood PAR, and the area of each place type it is calculated from
     Ratio = sqlalchemy.Column(Float)
+    OutdoorArea = sqlalchemy.Column(Float)
+    HouseArea = sqlalchemy.Column(Float)
+    CommercialArea = sqlalchemy.Column(Float)
 
     # Whether the neighbourhood has child neighbourhoods
     HasChilds = sqlalchemy.Column(Boolean)
@@ -75,8 +83,9 @@ class Neighbourhood(Base):
     # The neighbourhood's live count
     LiveCount = sqlalchemy.Column(Integer)
 
-    Name = sqlalchemy.Column(String)
-    OSMId = sqlalchemy.Column(String)
+    Name = sqlalchemy.Column(String(255))
+    # The OSM id (negative for relations), the PAR looks up the neighbourhoods by it
+    OSMId = sqlalchemy.Column(String(32), index=True)
 
     # Whether the neighbourhood is a relation (OSM type)
     IsRelation = sqlalchemy.Column(Boolean)
@@ -84,6 +93,10 @@ class Neighbourhood(Base):
     # Whether the area is a neighbourhood or something big like province
     IsBig = sqlalchemy.Column(Boolean)
 
+    # The area of the neighbourhood boundary (in square meters, used to weight its score in
+    # the score of its parents)
+    Area = sqlalchemy.Column(Float)
+
     # Users which are currently inside the neighbourhood
     Users = relationship("User", back_populates="LastLocation")
 
@@ -97,8 +110,80 @@ class Neighbourhood(Base):
 class ScoreLog(Base):
     """The score log table model"""
     __tablename__ = "ScoreLogs"
+    # A single score for each neighbourhood in a day
+    __table_args__ = (UniqueConstraint("NeighbourhoodId", "Date"), )
     Id = sqlalchemy.Column(Integer, primary_key=True, autoincrement=True)
     NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"))
     Neighbourhood = relationship("Neighbourhood", backref="ScoreLogs")
     Score = sqlalchemy.Column(Float)
+    # The roll-up reads all the scores of a date
+    Date = sqlalchemy.Column(DateTime, index=True)
+
+
+class BucketScoreLog(Base):
+    """The score of a neighbourhood in a time bucket of a day (eg. an hour of it, its night or
+    the rolling week ending on it)"""
+    __tablename__ = "BucketScoreLogs"
+    # A single score for each neighbourhood in a bucket of a day
+    __table_args__ = (UniqueConstraint("NeighbourhoodId", "Date", "Bucket"), )
+    Id = sqlalchemy.Column(Integer, primary_key=True, autoincrement=True)
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"))
+    Neighbourhood = relationship("Neighbourhood", backref="BucketScoreLogs")
+    # The bucket name (eg. hour-08, day, night or rolling-7d)
+    Bucket = sqlalchemy.Column(String(16))
+    Score = sqlalchemy.Column(Float)
     Date = sqlalchemy.Column(DateTime)
+
+
+class StayCount(Base):
+    """The number of stay reports of a user in a neighbourhood on a day, each run adds its
+    counts and the day's scores are calculated from them (the stay value isn't linear)"""
+    __tablename__ = "StayCounts"
+    # The day's scores read all the counts of a date
+    Date = sqlalchemy.Column(DateTime, primary_key=True)
+    UserId = sqlalchemy.Column(Integer, ForeignKey("Users.Id"), primary_key=True)
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"), primary_key=True)
+    Count = sqlalchemy.Column(Integer)
+
+
+class BucketStayCount(Base):
+    """The number of stay reports of a user in a neighbourhood in a time bucket of a day,
+    the bucket scores are calculated from them"""
+    __tablename__ = "BucketStayCounts"
+    Date = sqlalchemy.Column(DateTime, primary_key=True)
+    Bucket = sqlalchemy.Column(String(16), primary_key=True)
+    UserId = sqlalchemy.Column(Integer, ForeignKey("Users.Id"), primary_key=True)
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"), primary_key=True)
+    Count = sqlalchemy.Column(Integer)
+
+
+class HomeCandidate(Base):
+    """The overnight reports weight of the neighbourhoods most likely to be a user's home
+    (at most HOME_CANDIDATES for each user, see home_locations)"""
+    __tablename__ = "HomeCandidates"
+    UserId = sqlalchemy.Column(Integer, ForeignKey("Users.Id"), primary_key=True)
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"), primary_key=True)
+    # The decayed number of overnight reports, as of the last update
+    Weight = sqlalchemy.Column(Float)
+    UpdatedAt = sqlalchemy.Column(DateTime)
+
+
+class UserHome(Base):
+    """The home neighbourhood of each user, whose stays are not scored"""
+    __tablename__ = "UserHomes"
+    UserId = sqlalchemy.Column(Integer, ForeignKey("Users.Id"), primary_key=True)
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"))
+
+
+class ParFingerprint(Base):
+    """The hash of the inputs of each neighbourhood's last calculated PAR"""
+    __tablename__ = "ParFingerprints"
+    NeighbourhoodId = sqlalchemy.Column(Integer, ForeignKey("Neighbourhoods.Id"), primary_key=True)
+    Fingerprint = sqlalchemy.Column(String(64))
+
+
+class Checkpoint(Base):
+    """The progress of the incremental stages (eg. the last processed report)"""
+    __tablename__ = "Checkpoints"
+    Name = sqlalchemy.Column(String(64), primary_key=True)
+    Value = sqlalchemy.Column(String(64))
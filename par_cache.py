@@ -0,0 +1,127 @@
+"""Required functions to dump the geometries needed for the PAR to a local cache, and to
+calculate the PAR areas from it with an in-process spatial index (without PostGIS)"""
+import os
+import numpy as np
+import shapely
+
+# The number of rows fetched at once while dumping a layer
+DUMP_BATCH_SIZE = 10000
+
+# The layers of the cache and the query dumping each of them from the OSM database
+# (the neighbourhoods are passed as the targets CTE, the geometry is the last column)
+LAYER_QUERIES = {
+    # The boundaries of the neighbourhoods (osm_id)
+    "boundaries": (
+        "SELECT target.osm_id, ST_AsBinary(target.way) FROM targets AS target"
+    ),
+    # The classified buildings inside any of the neighbourhoods (is_house, way_area)
+    "buildings": (
+        "SELECT building.building_class = 'house', building.way_area, "
+            "ST_AsBinary(building.way) "
+        "FROM {buildings_table} AS building "
+        "WHERE EXISTS ("
+            "SELECT 1 FROM targets AS target WHERE ST_Within(building.way, target.way)"
+        ")"
+    ),
+    # The merged outdoor places intersecting any of the neighbourhoods (way_area)
+    "outdoors": (
+        "SELECT outdoor.way_area, ST_AsBinary(outdoor.way) "
+        "FROM {outdoors_table} AS outdoor "
+        "WHERE EXISTS ("
+            "SELECT 1 FROM targets AS target WHERE ST_Intersects(outdoor.way, target.way)"
+        ")"
+    ),
+}
+
+# The number of attribute columns of each layer
+LAYER_COLUMNS = {"boundaries": 1, "buildings": 2, "outdoors": 1}
+
+
+def dump(directory: str, osm_ids: list, connection, buildings_table: str,
+         outdoors_table: str) -> None:
+    """Dump the geometries and attributes needed to calculate the PAR of the specified
+    neighbourhoods to the cache directory (as WKB and NumPy files)"""
+    os.makedirs(directory, exist_ok=True)
+    for layer, query in LAYER_QUERIES.items():
+        query = (
+            # Select the boundaries of all the requested neighbourhoods
+            "WITH targets AS ( "
+                "SELECT DISTINCT ON (target.osm_id) target.osm_id, target.way "
+                "FROM planet_osm_polygon AS target "
+                "WHERE target.osm_id = ANY(%s) "
+            ") "
+            + query.format(buildings_table=buildings_table, outdoors_table=outdoors_table)
+        )
+
+        # Stream the layer with a server-side cursor
+        columns = []
+        lengths = []
+        with open(os.path.join(directory, f"{layer}.wkb"), "wb") as file, \
+                connection.cursor(name=f"par_cache_{layer}") as cursor:
+            cursor.itersize = DUMP_BATCH_SIZE
+            cursor.execute(query, (osm_ids, ))
+            for row in cursor:
+                *attributes, wkb = row
+                columns.append(attributes)
+                lengths.append(len(wkb))
+                file.write(wkb)
+        connection.commit()
+
+        # Store the offset of each geometry and each attribute column
+        np.save(os.path.join(directory, f"{layer}_offsets.npy"),
+                np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))))
+        attributes = np.array(columns, dtype=np.float64).reshape(len(columns),
+                                                                  LAYER_COLUMNS[layer])
+        for index in range(attributes.shape[1]):
+            np.save(os.path.join(directory, f"{layer}_{index}.npy"), attributes[:, index])
+
+
+def load_layer(directory: str, layer: str) -> tuple:
+    """Load the geometries and attribute columns of a layer, memory-mapping the files
+    (geometries, [columns])"""
+    offsets = np.load(os.path.join(directory, f"{layer}_offsets.npy"), mmap_mode="r")
+    path = os.path.join(directory, f"{layer}.wkb")
+    if offsets[-1] > 0:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        geometries = shapely.from_wkb([data[offsets[index]:offsets[index + 1]].tobytes()
+                                       for index in range(len(offsets) - 1)])
+    else:
+        geometries = np.empty(0, dtype=object)
+
+    columns = []
+    while os.path.exists(os.path.join(directory, f"{layer}_{len(columns)}.npy")):
+        columns.append(np.load(os.path.join(directory, f"{layer}_{len(columns)}.npy"),
+                               mmap_mode="r"))
+    return geometries, columns
+
+
+def get_areas(directory: str) -> dict:
+    """Get the area of each place type inside the cached neighbourhoods
+    ({osm_id: (outdoor_area, houses_area, commercial_area)})"""
+    boundaries, (osm_ids, ) = load_layer(directory, "boundaries")
+    buildings, (is_house, building_areas) = load_layer(directory, "buildings")
+    outdoors, (outdoor_areas, ) = load_layer(directory, "outdoors")
+    is_house = np.asarray(is_house, dtype=bool)
+
+    # Sum the buildings inside each of the neighbourhoods
+    boundary_index, building_index = shapely.STRtree(buildings).query(boundaries,
+                                                                       predicate="contains")
+    areas = np.asarray(building_areas)[building_index]
+    house_areas = np.bincount(boundary_index, weights=np.where(is_house[building_index], areas, 0),
+                              minlength=len(boundaries))
+    commercial_areas = np.bincount(boundary_index,
+                                   weights=np.where(is_house[building_index], 0, areas),
+                                   minlength=len(boundaries))
+
+    # Sum the part of the merged outdoor places inside each of the neighbourhoods
+    boundary_index, outdoor_index = shapely.STRtree(outdoors).query(boundaries,
+                                                                     predicate="intersects")
+    areas = np.asarray(outdoor_areas)[outdoor_index].copy()
+    partial = ~shapely.within(outdoors[outdoor_index], boundaries[boundary_index])
+    areas[partial] = shapely.area(shapely.intersection(outdoors[outdoor_index][partial],
+                                                       boundaries[boundary_index][partial]))
+    outdoor_sums = np.bincount(boundary_index, weights=areas, minlength=len(boundaries))
+
+    return {int(osm_id): (outdoor_area, house_area, commercial_area)
+            for osm_id, outdoor_area, house_area, commercial_area in
+            zip(osm_ids, outdoor_sums, house_areas, commercial_areas)}
@@ -0,0 +1,142 @@
+"""Required functions to measure the time spent in each stage of the analyzer"""
+import csv
+import json
+import time
+import threading
+import contextlib
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The number of slowest items (eg. neighbourhoods) kept in the report
+SLOWEST_COUNT = 20
+
+
+class Profiler:
+    """Records the wall time, database time and row count of each stage"""
+
+    def __init__(self):
+        # The stats of each stage {name: {"calls", "wall_time", "db_time", "rows"}}
+        self.stages = {}
+        # The time spent on each item of a stage {stage name: {item: seconds}}
+        self.items = {}
+        # The EXPLAIN ANALYZE output of each PostGIS query {name: plan}
+        self.explains = {}
+        # Whether to capture the EXPLAIN ANALYZE output of the PostGIS queries
+        self.explain = False
+        # Whether to time the neighbourhoods of the slowest PAR batches one at a time again
+        self.split_batches = False
+        self.lock = threading.Lock()
+        # The stages that are running in the current thread
+        self.local = threading.local()
+
+    def reset(self) -> None:
+        """Forget everything recorded so far"""
+        with self.lock:
+            self.stages = {}
+            self.items = {}
+            self.explains = {}
+
+    def get_stage(self, name: str) -> dict:
+        """Get the stats of the specified stage (must be called with the lock held)"""
+        return self.stages.setdefault(name, {"calls": 0, "wall_time": 0.0,
+                                             "db_time": 0.0, "rows": 0})
+
+    def running_stages(self) -> list:
+        """Get the names of the stages running in the current thread"""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Measure the wall time of the code run inside the context"""
+        stack = self.running_stages()
+        stack.append(name)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            stack.pop()
+            with self.lock:
+                stats = self.get_stage(name)
+                stats["calls"] += 1
+                stats["wall_time"] += elapsed
+
+    def add(self, db_time: float = 0.0, rows: int = 0) -> None:
+        """Add database time and rows to all the stages running in the current thread"""
+        with self.lock:
+            for name in self.running_stages():
+                stats = self.get_stage(name)
+                stats["db_time"] += db_time
+                stats["rows"] += max(rows, 0)
+
+    def add_item(self, name: str, item, seconds: float) -> None:
+        """Record the time spent on an item (eg. a neighbourhood) of the specified stage"""
+        with self.lock:
+            self.items.setdefault(name, {})[str(item)] = seconds
+
+    def execute(self, cursor, name: str, query: str, params: tuple = None,
+                explain: bool = True) -> None:
+        """Run a query on a psycopg2 cursor as its own stage, recording its time and row count
+        (and its EXPLAIN ANALYZE output the first time, if enabled and the query can be
+        explained, which isn't the case of the DDL statements)"""
+        if explain and self.explain and name not in self.explains:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+            plan = cursor.fetchone()[0]
+            with self.lock:
+                self.explains[name] = plan
+
+        start_time = time.perf_counter()
+        cursor.execute(query, params)
+        self.record(name, time.perf_counter() - start_time, cursor.rowcount)
+
+    def record(self, name: str, db_time: float, rows: int = 0) -> None:
+        """Record a query run outside of a stage (eg. by the async pipeline) as its own stage"""
+        with self.lock:
+            stats = self.get_stage(name)
+            stats["calls"] += 1
+            stats["wall_time"] += db_time
+            stats["db_time"] += db_time
+            stats["rows"] += max(rows, 0)
+
+    def attach(self, engine: Engine) -> None:
+        """Record the time and rows of the queries run through a SQL Alchemy engine"""
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+            self.add(elapsed, cursor.rowcount)
+
+    def slowest(self, count: int = SLOWEST_COUNT) -> dict:
+        """Get the slowest items of each stage {stage name: [(item, seconds)]}"""
+        with self.lock:
+            return {name: sorted(items.items(), key=lambda item: item[1], reverse=True)[:count]
+                    for name, items in self.items.items()}
+
+    def write_report(self, path: str) -> None:
+        """Write the report to a JSON file, or to a CSV file of the stages if the path ends
+        in .csv"""
+        if path.endswith(".csv"):
+            with open(path, "w", encoding="utf-8", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(["stage", "calls", "wall_time", "db_time", "rows"])
+                for name, stats in self.stages.items():
+                    writer.writerow([name, stats["calls"], round(stats["wall_time"], 6),
+                                     round(stats["db_time"], 6), stats["rows"]])
+            return
+
+        report = {
+            "stages": self.stages,
+            "slowest": self.slowest(),
+            "explains": self.explains,
+        }
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+
+
+# The profiler shared by all the stages
+profiler = Profiler()
@@ -0,0 +1,82 @@
+"""Required functions to calculate the scores of the parent neighbourhoods (eg. the provinces)
+from the scores of their childs"""
+from collections import deque
+from datetime import datetime
+from sqlalchemy.orm.session import Session
+
+from model import ChildParents, Neighbourhood, ScoreLog
+from calculate_scores import SCORE_REPLACE_UPDATE
+from profiling import profiler
+
+
+def calculate(session: Session, date=None) -> None:
+    """Calculate the score of every parent neighbourhood for the date (today by default) as the
+    area weighted mean of the scores of its direct childs, bottom-up in a single pass"""
+    date = date or datetime.utcnow().date()
+
+    # Link every neighbourhood to its direct parents
+    with profiler.stage("rollup.hierarchy"):
+        parents = get_direct_parents(
+            session.query(ChildParents.ParentsId, ChildParents.ChildsId))
+        # The number of direct childs of each parent that aren't scored yet
+        remaining = {}
+        for child_id, parent_ids in parents.items():
+            for parent_id in parent_ids:
+                remaining[parent_id] = remaining.get(parent_id, 0) + 1
+        areas = dict(session.query(Neighbourhood.Id, Neighbourhood.Area).filter(
+            Neighbourhood.Id.in_(list(parents))))
+
+    # The stored scores of the childs which aren't parents themselves (the stays are scored in
+    # the smallest neighbourhoods), the ones without stays have a score of 0
+    scores = {neighbourhood_id: score or 0 for neighbourhood_id, score in
+              session.query(ScoreLog.NeighbourhoodId, ScoreLog.Score).filter(
+                  ScoreLog.Date == date)
+              if neighbourhood_id not in remaining}
+
+    # Visit the childs before their parents (Kahn's algorithm, starting from the leaves)
+    with profiler.stage("rollup.calculate"):
+        # The weighted score sum, weight sum, score sum and childs count of each parent
+        sums = {}
+        parent_scores = {}
+        queue = deque(child_id for child_id in parents if child_id not in remaining)
+        while queue:
+            child_id = queue.popleft()
+            score = parent_scores.get(child_id, scores.get(child_id, 0))
+            weight = areas.get(child_id) or 0
+            for parent_id in parents.get(child_id, ()):
+                parent_sums = sums.setdefault(parent_id, [0, 0, 0, 0])
+                parent_sums[0] += score * weight
+                parent_sums[1] += weight
+                parent_sums[2] += score
+                parent_sums[3] += 1
+                remaining[parent_id] -= 1
+                if remaining[parent_id] == 0:
+                    # All the childs are scored, fall back to the plain mean without their areas
+                    weighted_sum, weight_sum, score_sum, count = parent_sums
+                    parent_scores[parent_id] = round(
+                        weighted_sum / weight_sum if weight_sum > 0 else score_sum / count, 2)
+                    queue.append(parent_id)
+
+    # Store all the parent scores with a single executemany
+    if parent_scores:
+        with profiler.stage("rollup.write"):
+            session.execute(
+                "INSERT INTO CovidAlerter.ScoreLogs (NeighbourhoodId, Score, Date) "
+                "VALUES (:neighbourhood_id, :score, :date) "
+                f"ON DUPLICATE KEY UPDATE {SCORE_REPLACE_UPDATE.format(table='ScoreLogs')}",
+                [{"neighbourhood_id": neighbourhood_id, "score": score, "date": date}
+                 for neighbourhood_id, score in parent_scores.items()]
+            )
+    with profiler.stage("rollup.commit"):
+        session.commit()
+
+def get_direct_parents(pairs) -> dict:
+    """Get the direct parents of each child from all the (parent, child) containment pairs
+    ({child: {parent}}, a parent is direct if it doesn't contain another parent of the child)"""
+    ancestors = {}
+    for parent_id, child_id in pairs:
+        ancestors.setdefault(child_id, set()).add(parent_id)
+    return {child_id: {parent_id for parent_id in parent_ids
+                       if not any(parent_id in ancestors.get(other_id, ())
+                                  for other_id in parent_ids)}
+            for child_id, parent_ids in ancestors.items()}
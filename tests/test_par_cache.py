@@ -0,0 +1,43 @@
+"""Tests of the PAR areas calculated from the local geometry cache"""
+import os
+import numpy as np
+import pytest
+import shapely
+
+import par_cache
+
+
+def write_layer(directory: str, layer: str, geometries: list, columns: list) -> None:
+    """Write a layer of the cache in the format of par_cache.dump"""
+    wkbs = [shapely.to_wkb(geometry) for geometry in geometries]
+    with open(os.path.join(directory, f"{layer}.wkb"), "wb") as file:
+        for wkb in wkbs:
+            file.write(wkb)
+    np.save(os.path.join(directory, f"{layer}_offsets.npy"),
+            np.concatenate(([0], np.cumsum([len(wkb) for wkb in wkbs], dtype=np.int64))))
+    for index, column in enumerate(columns):
+        np.save(os.path.join(directory, f"{layer}_{index}.npy"),
+                np.array(column, dtype=np.float64))
+
+
+def test_areas(tmp_path):
+    """Only the buildings inside a neighbourhood are summed, and only the part of the outdoor
+    places inside it"""
+    directory = str(tmp_path)
+    write_layer(directory, "boundaries", [shapely.box(0, 0, 10, 10), shapely.box(20, 0, 30, 10)],
+                [[-1, -2]])
+    # A house and a commercial building inside the first neighbourhood, one crossing its
+    # boundary and one outside of both
+    write_layer(directory, "buildings",
+                [shapely.box(1, 1, 2, 2), shapely.box(3, 3, 5, 5), shapely.box(9, 9, 11, 11),
+                 shapely.box(14, 0, 15, 1)],
+                [[1, 0, 1, 0], [1, 4, 4, 1]])
+    # An outdoor place inside the first neighbourhood, one half inside and one outside of both
+    write_layer(directory, "outdoors",
+                [shapely.box(1, 6, 4, 9), shapely.box(8, 0, 12, 2), shapely.box(14, 4, 16, 6)],
+                [[9, 8, 4]])
+
+    areas = par_cache.get_areas(directory)
+    assert areas.keys() == {-1, -2}
+    assert areas[-1] == pytest.approx((13, 1, 4))
+    assert areas[-2] == pytest.approx((0, 0, 0))
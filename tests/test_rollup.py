@@ -0,0 +1,79 @@
+"""Tests of the parent neighbourhood roll-up"""
+from datetime import date
+import pytest
+
+import rollup_scores
+from model import ChildParents, Neighbourhood, ScoreLog
+
+# A province (100) with two counties (10, 20) and four small neighbourhoods (1-4), as all the
+# (parent, child) containment pairs build_hierarchy stores
+PAIRS = [(100, 10), (100, 20), (100, 1), (100, 2), (100, 3), (100, 4),
+         (10, 1), (10, 2), (20, 3), (20, 4)]
+# The boundary areas (the neighbourhoods of county 20 have none)
+AREAS = {1: 1.0, 2: 3.0, 3: None, 4: None, 10: 2.0, 20: 2.0, 100: 10.0}
+# The stored scores of the day (neighbourhood 4 has no stays)
+SCORES = {1: 4.0, 2: 8.0, 3: 5.0}
+DATE = date(2021, 1, 1)
+
+
+class FakeQuery:
+    """The rows of a query of FakeSession, ignoring the filters"""
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def filter(self, *_):
+        """Ignore the filter"""
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSession:
+    """A session returning the rows of the hierarchy, the areas and the scores of the day, and
+    recording the parameters of the executed statements"""
+
+    def __init__(self):
+        self.params = []
+
+    def query(self, *columns):
+        """Get the rows of the table of the queried columns"""
+        if columns[0] is ChildParents.ParentsId:
+            return FakeQuery(PAIRS)
+        if columns[0] is Neighbourhood.Id:
+            return FakeQuery(list(AREAS.items()))
+        if columns[0] is ScoreLog.NeighbourhoodId:
+            return FakeQuery(list(SCORES.items()))
+        raise AssertionError(f"Unexpected query of {columns}")
+
+    def execute(self, _, params):
+        """Record the parameters of the statement"""
+        self.params.append(params)
+
+    def commit(self):
+        """Nothing to commit"""
+
+
+def test_direct_parents():
+    """Only the smallest enclosing neighbourhoods are direct parents"""
+    assert rollup_scores.get_direct_parents(PAIRS) == {
+        1: {10}, 2: {10}, 3: {20}, 4: {20}, 10: {100}, 20: {100}}
+
+
+def test_direct_parents_of_siblings():
+    """A child inside two neighbourhoods which don't contain each other has both as parents"""
+    assert rollup_scores.get_direct_parents([(10, 1), (20, 1), (100, 1), (100, 10),
+                                             (100, 20)]) == {1: {10, 20}, 10: {100}, 20: {100}}
+
+
+def test_area_weighted_rollup():
+    """The parents are scored bottom-up with the area weighted mean of their direct childs,
+    falling back to the plain mean when the childs have no area"""
+    session = FakeSession()
+    rollup_scores.calculate(session, DATE)
+    assert len(session.params) == 1
+    scores = {row["neighbourhood_id"]: row["score"] for row in session.params[0]}
+    assert all(row["date"] == DATE for row in session.params[0])
+    # (4 * 1 + 8 * 3) / 4, (5 + 0) / 2 and (7 * 2 + 2.5 * 2) / 4
+    assert scores == {10: 7.0, 20: 2.5, 100: pytest.approx(4.75)}
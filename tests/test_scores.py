@@ -0,0 +1,133 @@
+"""Tests of the stay detection engines"""
+import random
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+
+import calculate_scores
+import vectorized_scores
+
+# The time of the first report and the time between two reports
+START = datetime(2021, 1, 1)
+STEP = timedelta(minutes=calculate_scores.REPORT_MINUTES)
+
+
+def generate_reports(users: int, count: int, seed: int) -> list:
+    """Generate the reports of users walking between a few neighbourhoods (None is outside of
+    them), with a few long gaps ([(Id, UserId, NeighbourhoodId, Timestamp)] in id and time order)"""
+    rng = random.Random(seed)
+    reports = []
+    for user_id in range(1, users + 1):
+        timestamp = START + rng.randrange(4) * STEP
+        neighbourhood_id = rng.randrange(1, 5)
+        for _ in range(count):
+            if rng.random() < 0.3:
+                neighbourhood_id = rng.choice((None, 1, 2, 3, 4))
+            timestamp += STEP * (3 if rng.random() < 0.05 else 1)
+            reports.append((user_id, neighbourhood_id, timestamp))
+    reports.sort(key=lambda report: report[2])
+    return [(index + 1, *report) for index, report in enumerate(reports)]
+
+
+def select_reports(reports: list, mark: int, last_id: int) -> list:
+    """Select the reports needed to find the stays after the high-water mark like
+    calculate_scores.get_reports_source, ordered by user and time
+    ([(UserId, NeighbourhoodId, IsNew, Timestamp)])"""
+    new_reports = [report for report in reports if mark < report[0] <= last_id]
+    rows = [(report, True) for report in new_reports]
+    for user_id in {report[1] for report in new_reports}:
+        old_reports = sorted((report for report in reports
+                              if report[1] == user_id and report[0] <= mark),
+                             key=lambda report: report[3])
+        rows.extend((report, False) for report in
+                    old_reports[-calculate_scores.CONTEXT_REPORTS:])
+    rows.sort(key=lambda row: (row[0][1], row[0][3], row[0][0]))
+    return [(report[1], report[2], is_new, report[3]) for report, is_new in rows]
+
+
+def stream_counts(rows: list, detector: calculate_scores.StayDetector = None) -> dict:
+    """Count the stay reports of each user in each neighbourhood with the stream engine"""
+    detector = detector or calculate_scores.StayDetector()
+    for row in rows:
+        detector.add(*row)
+    return detector.finish()
+
+
+def numpy_counts(rows: list) -> dict:
+    """Count the stay reports of each user in each neighbourhood with the NumPy engine"""
+    user_ids, neighbourhood_ids, counts = vectorized_scores.count_stays({
+        "UserId": np.array([row[0] for row in rows], dtype=np.int64),
+        "NeighbourhoodId": np.array([-1 if row[1] is None else row[1] for row in rows],
+                                    dtype=np.int64),
+        "IsNew": np.array([row[2] for row in rows], dtype=bool),
+        "Timestamp": np.array([int((row[3] - START).total_seconds()) for row in rows],
+                              dtype=np.int64),
+    })
+    return dict(zip(zip(user_ids.tolist(), neighbourhood_ids.tolist()), counts.tolist()))
+
+
+def get_scores(counts: dict) -> dict:
+    """Sum the stay values of each neighbourhood from the stay counts like
+    calculate_scores.get_day_scores_query"""
+    scores = {}
+    for (_, neighbourhood_id), count in counts.items():
+        value = round(max(count - calculate_scores.CONSECUTIVE_COUNT, 0) **
+                      calculate_scores.STAY_EXPONENT + 1, 2)
+        scores[neighbourhood_id] = scores.get(neighbourhood_id, 0) + value
+    return scores
+
+
+def add_counts(totals: dict, counts: dict) -> None:
+    """Add the counts of a run to the stored ones"""
+    for key, count in counts.items():
+        totals[key] = totals.get(key, 0) + count
+
+
+def test_counted_run_is_not_scored_again():
+    """A run of old reports which was already a stay has no new stay reports"""
+    reports = [(1, 1, 7, START), (2, 1, 7, START + STEP), (3, 1, 7, START + 2 * STEP),
+               (4, 1, 8, START + 3 * STEP)]
+    rows = select_reports(reports, 3, 4)
+    assert stream_counts(rows) == {}
+    assert numpy_counts(rows) == {}
+
+
+@pytest.mark.parametrize("mark", [0, 100, 1234, 2999])
+def test_stream_and_numpy_engines_match(mark):
+    """The stream and NumPy engines find the same stays in new and context reports"""
+    reports = generate_reports(30, 100, mark)
+    rows = select_reports(reports, mark, len(reports))
+    assert stream_counts(rows) == numpy_counts(rows)
+
+
+@pytest.mark.parametrize("runs", [2, 4, 12, 48])
+def test_incremental_runs_match_a_full_run(runs):
+    """Adding up the stay counts of the incremental runs gives the scores of a full run"""
+    reports = generate_reports(30, 100, runs)
+    marks = [len(reports) * index // runs for index in range(runs + 1)]
+    stream_totals = {}
+    numpy_totals = {}
+    for mark, last_id in zip(marks, marks[1:]):
+        rows = select_reports(reports, mark, last_id)
+        add_counts(stream_totals, stream_counts(rows))
+        add_counts(numpy_totals, numpy_counts(rows))
+
+    full = stream_counts(select_reports(reports, 0, len(reports)))
+    assert stream_totals == full
+    assert numpy_totals == full
+    assert get_scores(stream_totals) == pytest.approx(get_scores(full))
+
+
+def test_incremental_bucket_runs_match_a_full_run():
+    """Adding up the bucket stay counts of the incremental runs gives the ones of a full run"""
+    reports = generate_reports(30, 100, 0)
+    marks = [len(reports) * index // 12 for index in range(13)]
+    totals = {}
+    for mark, last_id in zip(marks, marks[1:]):
+        detector = calculate_scores.BucketStayDetector()
+        stream_counts(select_reports(reports, mark, last_id), detector)
+        add_counts(totals, detector.bucket_counts)
+
+    detector = calculate_scores.BucketStayDetector()
+    stream_counts(select_reports(reports, 0, len(reports)), detector)
+    assert totals == detector.bucket_counts
@@ -0,0 +1,109 @@
+"""Required functions to find the stays and calculate the scores with vectorized NumPy operations"""
+import numpy as np
+from sqlalchemy.orm.session import Session
+
+import calculate_scores
+from home_locations import get_home_join
+
+# The number of rows fetched at once while loading the reports
+LOAD_BATCH_SIZE = 100000
+
+
+def calculate(session: Session, mark: int, last_id: int) -> list:
+    """Find the stays in the reports after the specified high-water mark and count the stay
+    reports of each user in each neighbourhood ([(UserId, NeighbourhoodId, Count)])"""
+    reports = load_reports(session, mark, last_id)
+    user_ids, neighbourhood_ids, counts = count_stays(reports)
+    return list(zip(user_ids.tolist(), neighbourhood_ids.tolist(), counts.tolist()))
+
+
+def load_reports(session: Session, mark: int, last_id: int) -> dict:
+    """Load the reports needed to score the reports after the specified high-water mark as
+    columns sorted by (UserId, Timestamp, Id)
+    ({"UserId", "NeighbourhoodId", "Timestamp", "IsNew", "IsHome"},
+    reports without a neighbourhood have -1)"""
+    query = (
+        "SELECT reports.UserId, COALESCE(reports.NeighbourhoodId, -1), "
+        "UNIX_TIMESTAMP(reports.Timestamp), reports.IsNew, home.UserId IS NOT NULL, reports.Id "
+        f"FROM ({calculate_scores.get_reports_source(mark)}) AS reports "
+        # Mark the reports sent from the users' homes
+        + get_home_join("reports")
+    )
+    rows = session.execute(query, {"mark": mark, "last_id": last_id})
+    batches = []
+    while True:
+        batch = rows.fetchmany(LOAD_BATCH_SIZE)
+        if not batch:
+            break
+        batches.append(np.array(batch, dtype=np.int64))
+    table = np.concatenate(batches) if batches else np.empty((0, 6), dtype=np.int64)
+
+    # Sort the reports in memory rather than on the database server (the reports sent at the
+    # same time are ordered by id, like the other engines)
+    order = np.lexsort((table[:, 5], table[:, 2], table[:, 0]))
+    table = table[order]
+    return {
+        "UserId": table[:, 0],
+        "NeighbourhoodId": table[:, 1],
+        "Timestamp": table[:, 2],
+        "IsNew": table[:, 3].astype(bool),
+        "IsHome": table[:, 4].astype(bool),
+    }
+
+
+def count_stays(reports: dict, consecutive_count: int = calculate_scores.CONSECUTIVE_COUNT,
+                max_gap_seconds: int = calculate_scores.MAX_GAP_SECONDS) -> tuple:
+    """Find the stays in the reports and count the stay reports of each user in each
+    neighbourhood (user ids, neighbourhood ids, counts)"""
+    user_ids = reports["UserId"]
+    neighbourhood_ids = reports["NeighbourhoodId"]
+    timestamps = reports["Timestamp"]
+    is_new = reports["IsNew"]
+    # The stays at the users' homes aren't scored (see home_locations)
+    is_home = reports.get("IsHome", np.zeros(len(user_ids), dtype=bool))
+    if len(user_ids) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+
+    # Run-length encode the reports of each user in the same neighbourhood, a long gap between
+    # two reports splits the run too
+    starts = np.flatnonzero(np.concatenate((
+        [True],
+        (user_ids[1:] != user_ids[:-1]) | (neighbourhood_ids[1:] != neighbourhood_ids[:-1]) |
+        (np.diff(timestamps) > max_gap_seconds)
+    )))
+    lengths = np.diff(np.append(starts, len(user_ids)))
+    old_lengths = np.add.reduceat((~is_new).astype(np.int64), starts)
+    new_lengths = lengths - old_lengths
+
+    # Count the stay reports of each run, the old reports were already counted on the last run
+    # if they were a stay by themselves
+    counts = np.where(
+        (lengths >= consecutive_count) & (neighbourhood_ids[starts] >= 0) & ~is_home[starts],
+        new_lengths + np.where(old_lengths < consecutive_count, old_lengths, 0),
+        0
+    )
+    stays = counts > 0
+
+    # Sum the stay reports of each user in each neighbourhood
+    pairs, pair_index = np.unique(
+        np.stack((user_ids[starts][stays], neighbourhood_ids[starts][stays]), axis=1),
+        axis=0, return_inverse=True)
+    pair_counts = np.bincount(pair_index.ravel(), weights=counts[stays], minlength=len(pairs))
+    return pairs[:, 0], pairs[:, 1], pair_counts.astype(np.int64)
+
+
+def score_reports(reports: dict, consecutive_count: int = calculate_scores.CONSECUTIVE_COUNT,
+                  exponent: float = calculate_scores.STAY_EXPONENT,
+                  max_gap_seconds: int = calculate_scores.MAX_GAP_SECONDS) -> tuple:
+    """Find the stays in the reports and sum the stay values of each neighbourhood
+    (neighbourhood ids, sums)"""
+    _, neighbourhood_ids, counts = count_stays(reports, consecutive_count, max_gap_seconds)
+
+    # Add 1 point for the first reports, and decrease the weight of the rest
+    values = np.round(np.maximum(counts - consecutive_count, 0) ** exponent + 1, 2)
+
+    # Sum the values of each neighbourhood
+    neighbourhoods, neighbourhood_index = np.unique(neighbourhood_ids, return_inverse=True)
+    return neighbourhoods, np.bincount(neighbourhood_index.ravel(), weights=values,
+                                       minlength=len(neighbourhoods))